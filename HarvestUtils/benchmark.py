@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+benchmark.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import csv
+import datetime
+import imp
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import sqlalchemy
+from sqlalchemy import func, select
+
+from config import cfg
+from model import *
+import profiling
+import rollup
+import storage
+
+log = logging.getLogger("benchmark")
+
+TASKS = [u"Development", u"Testing", u"Meeting", u"Semester", u"Sjuk",
+         u"Komptid", u"Kompetensutveckling", u"Administration"]
+
+FIRST_NAMES = [u"Anna", u"Bo", u"Cecilia", u"David", u"Eva", u"Fredrik", u"Gunilla", u"Henrik", u"Ingrid", u"Johan",
+               u"Karin", u"Lars", u"Maria", u"Nils", u"Olle", u"Per", u"Sara", u"Tomas", u"Ulla", u"\xc5sa"]
+LAST_NAMES = [u"Andersson", u"Berg", u"Carlsson", u"Ek", u"Eriksson", u"Gustafsson", u"Holm", u"Johansson",
+              u"Karlsson", u"Larsson", u"Lind", u"Nilsson", u"Persson", u"Str\xf6m", u"Svensson", u"\xd6berg"]
+OFFICES = [u"Gothenburg", u"Stockholm", u"Malm\xf6"]
+CUSTOMER_TASKS = [u"Development", u"Testing", u"Meeting", u"Project management"]
+INTERNAL_TASKS = [u"Semester", u"Sjuk", u"Komptid", u"Kompetensutveckling", u"Administration"]
+
+# The header lines of the generated files, as exported by Harvest and kept by hand
+HARVEST_HEADER = ["Date", "Client", "Project", "Project Code", "Task", "Notes", "Hours", "First Name", "Last Name",
+                  "Billable?", "Employee?", "Approved", "Hourly Rate", "Cost", "Department"]
+PO_HEADER = ["employee", "customer", "reference", "price", "start", "stop", "po-number"]
+CW_HEADER = ["employee", "number", "office"]
+
+def _load_report_module():
+  "monthly-report.py is not a valid module name, load it by path."
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "monthly-report.py")
+  return imp.load_source("monthly_report", path)
+
+def synthetic_db(url, years=5, employees=200, projects=40, last_year=2009, seed=1):
+  """
+    Return an engine for the DB at url, filled with years of synthetic
+    Harvest data ending with last_year if it is empty. Every employee
+    reports one to three tasks on every weekday and has a purchase order
+    per year. The rows are written with bulk inserts. A DB with employees
+    that synthetic_db() did not make is refused, the benchmarks drop
+    indexes and rollups.
+  """
+  engine = sqlalchemy.create_engine(url)
+  metadata.create_all(bind=engine)
+  e = Employee.table
+  if engine.execute(select([func.count(e.c.name)], ~e.c.name.like(u"Employee %"))).scalar() > 0:
+    engine.dispose()
+    raise Exception, "%s is not a synthetic DB, it is left alone" % url
+  if engine.execute(select([func.count(e.c.name)])).scalar() == 0:
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+      log.info("Created %d synthetic tasks" % _fill(connection, years, employees, projects, last_year, seed))
+      transaction.commit()
+    except:
+      transaction.rollback()
+      raise
+    connection.close()
+  return engine
+
+def _fill(connection, years, employees, projects, last_year, seed):
+  "Insert the rows of synthetic_db() with connection, returns the number of tasks."
+  rnd = random.Random(seed)
+  customers = [u"Customer %d" % i for i in range(max(projects / 4, 1))]
+  connection.execute(Customer.table.insert(), [{'id': i + 1, 'name': name} for i, name in enumerate(customers)])
+  connection.execute(Project.table.insert(), [{'id': i + 1, 'name': u"Project %d" % i, 'customer_id': i % len(customers) + 1} for i in range(projects)])
+  connection.execute(Office.table.insert(), [{'id': 1, 'name': u"Gothenburg"}, {'id': 2, 'name': u"Stockholm"}])
+  names = [u"Employee %03d" % i for i in range(employees)]
+  connection.execute(Employee.table.insert(), [{'name': name, 'number': i, 'office_id': i % 2 + 1} for i, name in enumerate(names)])
+
+  first_year = last_year - years + 1
+  pos = []
+  for name in names:
+    for year in range(first_year, last_year + 1):
+      pos.append({'number': len(pos), 'start': datetime.date(year, 1, 1), 'stop': datetime.date(year, 12, 31),
+                  'price': 900, 'customer': rnd.choice(customers), 'reference': u"Ref", 'employee_name': name})
+  connection.execute(PurchaseOrder.table.insert(), pos)
+
+  count = 0
+  day = datetime.date(first_year, 1, 1)
+  while day.year <= last_year:
+    if day.weekday() < 5:
+      rows = []
+      for name in names:
+        for i in range(rnd.randint(1, 3)):
+          task = rnd.choice(TASKS)
+          rows.append({'name': task, 'date': day, 'hours': rnd.choice([1.0, 2.0, 2.5, 4.0, 8.0]),
+                       'billable': task == u"Development", 'employee_name': name,
+                       'project_id': rnd.randint(1, projects)})
+      connection.execute(Task.table.insert(), rows)
+      count += len(rows)
+    day += datetime.timedelta(days=1)
+  return count
+
+def _names(employees):
+  "Return employees unique (first name, last name) pairs."
+  result = []
+  for i in range(employees):
+    first = FIRST_NAMES[i % len(FIRST_NAMES)]
+    last = LAST_NAMES[(i / len(FIRST_NAMES)) % len(LAST_NAMES)]
+    generation = i / (len(FIRST_NAMES) * len(LAST_NAMES))
+    if generation > 0:
+      last = u"%s %d" % (last, generation + 1)
+    result.append((first, last))
+  return result
+
+def _writer(path, header):
+  f = file(path, "wb")
+  writer = csv.writer(f, lineterminator="\n")
+  writer.writerow(header)
+  return f, writer
+
+def _row(values):
+  return [unicode(value).encode("utf-8") for value in values]
+
+def write_csvs(directory, years=1, employees=50, projects=10, last_year=2009, seed=1):
+  """
+    Write synthetic Harvest, purchase order and coworker CSV files to
+    directory, in the formats update_db.py reads. Every employee works on
+    one customer project a year and reports one to three different tasks
+    on every weekday, some of them on the internal project. Returns the
+    paths of the coworker, purchase order and Harvest files, in the order
+    they should be imported, and the number of Harvest entries.
+  """
+  rnd = random.Random(seed)
+  names = _names(employees)
+  customers = [u"Customer %d" % i for i in range(max(projects / 3, 1))]
+  work = [(customers[i % len(customers)], u"Project %d" % i) for i in range(projects)]
+  first_year = last_year - years + 1
+  assigned = {}
+  for first, last in names:
+    for year in range(first_year, last_year + 1):
+      assigned[(first, last, year)] = rnd.choice(work)
+
+  paths = [os.path.join(directory, name) for name in ("coworkers.csv", "purchase-orders.csv", "harvest.csv")]
+  f, writer = _writer(paths[0], CW_HEADER)
+  try:
+    for number, (first, last) in enumerate(names):
+      writer.writerow(_row([u"%s %s" % (first, last), number + 1, OFFICES[number % len(OFFICES)]]))
+  finally:
+    f.close()
+
+  f, writer = _writer(paths[1], PO_HEADER)
+  try:
+    number = 1000
+    for (first, last, year), (customer, project) in sorted(assigned.items()):
+      writer.writerow(_row([u"%s %s" % (first, last), customer, u"Ref %s" % project, rnd.choice([850, 900, 950, 1000]),
+                            datetime.date(year, 1, 1), datetime.date(year, 12, 31), number]))
+      number += 1
+  finally:
+    f.close()
+
+  f, writer = _writer(paths[2], HARVEST_HEADER)
+  count = 0
+  try:
+    day = datetime.date(first_year, 1, 1)
+    while day.year <= last_year:
+      if day.weekday() < 5:
+        for first, last in names:
+          customer, project = assigned[(first, last, day.year)]
+          tasks = [(customer, project, task) for task in CUSTOMER_TASKS] + [(u"Purple Scout", u"Internal", rnd.choice(INTERNAL_TASKS))]
+          # Different tasks, or the entries would have the same digest
+          for customer, project, task in rnd.sample(tasks, rnd.randint(1, 3)):
+            billable = project != u"Internal" and "billable" or "non-billable"
+            note = rnd.random() < 0.05 and u'Fixed "%s", see the wiki' % task or u""
+            writer.writerow(_row([day, customer, project, u"", task, note, rnd.choice([0.5, 1, 2, 2.5, 4, 8]),
+                                  first, last, billable, u"employee", u"yes", 0.0, 0.0, u"Dev"]))
+            count += 1
+      day += datetime.timedelta(days=1)
+  finally:
+    f.close()
+  return paths, count
+
+def timed(func, *args):
+  "Return the number of seconds it took to call func(*args)."
+  ts = time.time()
+  func(*args)
+  return time.time() - ts
+
+def _bound(engine, func, *args):
+  "Call func(*args) with the model bound to engine instead of the configured DB."
+  bind = metadata.bind
+  metadata.bind = engine
+  try:
+    return func(*args)
+  finally:
+    session.close()
+    metadata.bind = bind
+
+def bench_indexes(engine, period):
+  """
+    Time the monthly report for period without and with the report
+    indexes (see model.INDEXES) in the DB of engine, a synthetic_db().
+    Returns the two timings in seconds.
+  """
+  names = [index_name(entity, columns) for entity, columns in INDEXES]
+  indexes = [index for table in metadata.tables.values() for index in table.indexes if index.name in names]
+  def bench():
+    report = _load_report_module().MonthlyReport(period)
+    report.get_report()  # Warm up the caches
+    for index in indexes:
+      index.drop(bind=engine)
+    try:
+      before = timed(report.get_report)
+    finally:
+      for index in indexes:
+        index.create(bind=engine)
+    after = timed(report.get_report)
+    return before, after
+  return _bound(engine, bench)
+
+def bench_rollups(engine, period):
+  """
+    Time the monthly report for period reading the tasks and reading the
+    rollups in the DB of engine, a synthetic_db(). The rollups are rebuilt
+    first if they are not current. Returns the two timings in seconds.
+  """
+  def bench():
+    report = _load_report_module().MonthlyReport(period)
+    if not rollup.is_current():
+      ts = time.time()
+      rollup.rebuild()
+      log.info("Rebuilt the rollups in %0.2f seconds" % (time.time() - ts))
+    r = RollupState.table
+    last, tasks = session.execute(select([r.c.last_task, r.c.tasks])).fetchone()
+    session.execute(r.delete())  # Makes the rollups stale
+    if rollup.is_current():
+      raise Exception, "The rollups should be stale without their state"
+    before = timed(report.get_report)
+    session.execute(r.insert(), {'last_task': last, 'tasks': tasks})
+    if not rollup.is_current():
+      raise Exception, "The rollups should be current with their state restored"
+    after = timed(report.get_report)
+    session.commit()
+    return before, after
+  return _bound(engine, bench)
+
+# The stages of bench_end_to_end(), named after the scripts they time. The
+# memory-load stage is only run in the memory mode.
+STAGES = ("generate", "update_db", "memory-load", "monthly-report", "statistics_month")
+
+def bench_end_to_end(directory, employees, years=1, projects=10, period="2009-05", bulk=False, mode="default"):
+  """
+    Write CSV files of the given size to directory, import them into a new
+    DB there with the mappers update_db.py picks, make the monthly report
+    for period and the statistics of every employee for the month. The DB
+    is bound in mode, one of storage.MODES, only for the run. In the memory
+    mode the import includes saving the DB to disk, and loading it again
+    is timed as a stage of its own. Returns one result dict per stage with
+    the size, mode, seconds, rows, SQL statements and time and peak RSS,
+    see write_results().
+  """
+  import update_db
+  from statistics_month import Statistics, DateModel
+  report = _load_report_module()
+  path = os.path.join(directory, "benchmark-%d-%d-%d.sqlite" % (employees, years, projects))
+  if os.path.exists(path):
+    os.remove(path)
+  bind = metadata.bind
+  url = "sqlite:///%s" % path
+  storage.bind(metadata, url, mode)
+  profiler = profiling.start(metadata.bind, "benchmark")
+  try:
+    profiler.begin("generate")
+    paths, tasks = write_csvs(directory, years, employees, projects, int(period[:4]))
+    profiler.end(tasks)
+    profiler.begin("update_db")
+    for csvfile in paths:
+      update_db._get_mapper(csvfile, bulk).map()
+    if mode == "memory":
+      storage.save(metadata.bind, url)
+    profiler.end(tasks)
+    session.clear()
+    if mode == "memory":
+      profiler.begin("memory-load")
+      engine = storage.create_engine(url, mode)
+      metadata.create_all(bind=engine)
+      profiler.end(storage.load(engine, metadata, url))
+      engine.dispose()
+    profiler.begin("monthly-report")
+    report.MonthlyReport(period).get_report()
+    profiler.end(employees)
+    profiler.begin("statistics_month")
+    date = DateModel("%s-01" % period)
+    for employee in Employee.query.all():
+      Statistics(date).by_employee(employee.name)
+    profiler.end(employees)
+  finally:
+    profiling.stop()
+    session.close()
+    metadata.bind.dispose()
+    metadata.bind = bind
+
+  results = []
+  for phase in profiler.phases:
+    if phase.name in STAGES:
+      results.append({ 'employees': employees, 'years': years, 'projects': projects, 'tasks': tasks, 'mode': mode,
+                       'stage': phase.name, 'seconds': phase.wall, 'rows': phase.rows,
+                       'statements': phase.statements, 'sql_time': phase.sql_time, 'peak_rss': phase.peak_rss })
+  return results
+
+def _result_key(result):
+  return (result['employees'], result['years'], result['projects'], result.get('mode', "default"), result['stage'])
+
+def write_results(out, results, before=None):
+  """
+    Write results from bench_end_to_end() as a table to out. If before, the
+    results of an earlier run, is given the seconds of the same stage and
+    size are listed next to them.
+  """
+  previous = dict([(_result_key(result), result['seconds']) for result in before or []])
+  out.write("%9s %5s %8s %-8s %-16s %8s %10s %7s %10s" % ("Employees", "Years", "Tasks", "Mode", "Stage", "Seconds", "Rows/s", "SQL", "RSS (KB)"))
+  if before is not None:
+    out.write(" %8s %7s" % ("Before", "Change"))
+  out.write("\n")
+  for result in results:
+    out.write("%9d %5d %8d %-8s %-16s %8.3f %10.0f %7d %10d" % (result['employees'], result['years'], result['tasks'], result.get('mode', "default"), result['stage'],
+                                                                result['seconds'], result['rows'] / max(result['seconds'], 0.000001), result['statements'], result['peak_rss']))
+    if before is not None:
+      seconds = previous.get(_result_key(result))
+      if seconds is None:
+        out.write(" %8s %7s" % ("-", "-"))
+      else:
+        out.write(" %8.3f %+6.0f%%" % (seconds, (result['seconds'] - seconds) * 100 / max(seconds, 0.000001)))
+    out.write("\n")
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=cfg['loglevel'],format=cfg['logformat'])
+  parser = OptionParser(usage="benchmark.py [options]")
+  parser.add_option("--db", default="sqlite:///./data/benchmark.sqlite",
+                    help="database to fill with synthetic data")
+  parser.add_option("--years", type="int", default=5)
+  parser.add_option("--employees", type="int", default=200)
+  parser.add_option("--period", default="2009-05",
+                    help="month to run the reports for, YYYY-MM")
+  parser.add_option("--end-to-end", action="store_true", default=False,
+                    help="generate CSV files, import them and make the reports instead")
+  parser.add_option("--sizes", default="10,50",
+                    help="comma separated numbers of employees to run --end-to-end with")
+  parser.add_option("--projects", type="int", default=10)
+  parser.add_option("--bulk", action="store_true", default=False,
+                    help="import with bulk inserts, see update_db.py")
+  parser.add_option("--modes", default="default",
+                    help="comma separated DB modes to run --end-to-end in, see storage.MODES")
+  parser.add_option("--directory",
+                    help="where to keep the CSV files and DBs, a temporary directory if not given")
+  parser.add_option("--results", metavar="FILE",
+                    help="write the --end-to-end results as JSON to FILE")
+  parser.add_option("--compare", metavar="FILE",
+                    help="compare the --end-to-end results with the ones in FILE")
+  (options, args) = parser.parse_args()
+
+  if options.end_to_end:
+    directory = options.directory or tempfile.mkdtemp()
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    results = []
+    try:
+      for employees in [int(size) for size in options.sizes.split(",")]:
+        for mode in options.modes.split(","):
+          results += bench_end_to_end(directory, employees, options.years, options.projects, options.period, options.bulk, mode)
+    finally:
+      if options.directory is None:
+        shutil.rmtree(directory)
+    before = None
+    if options.compare:
+      before = json.load(file(options.compare))['results']
+    write_results(sys.stdout, results, before)
+    if options.results:
+      f = file(options.results, "w")
+      try:
+        json.dump({'command': " ".join(sys.argv), 'started': time.time(), 'results': results}, f, indent=2, sort_keys=True)
+        f.write("\n")
+      finally:
+        f.close()
+    sys.exit(0)
+
+  engine = synthetic_db(options.db, options.years, options.employees)
+  before, after = bench_indexes(engine, options.period)
+  print "Monthly report %s without indexes: %0.2f seconds" % (options.period, before)
+  print "Monthly report %s with indexes:    %0.2f seconds" % (options.period, after)
+  before, after = bench_rollups(engine, options.period)
+  print "Monthly report %s from tasks:      %0.2f seconds" % (options.period, before)
+  print "Monthly report %s from rollups:    %0.2f seconds" % (options.period, after)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+calendars.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import unittest
+
+from config import cfg
+
+ONE_DAY = datetime.timedelta(days=1)
+ONE_WEEK = datetime.timedelta(days=7)
+
+_iso_weeks = {}
+
+def iso_weeks(year):
+  """
+    Return the ISO weeks of year as a list of (week, monday, sunday) with
+    datetime.date values. Week 1 is the week with the year's first Thursday
+    (the one with January 4th), a year has 52 or 53 weeks. The list is
+    computed once per year.
+  """
+  weeks = _iso_weeks.get(year)
+  if weeks is None:
+    jan4 = datetime.date(year, 1, 4)
+    monday = jan4 - datetime.timedelta(days=jan4.weekday())
+    weeks = []
+    while monday.isocalendar()[0] == year:
+      weeks.append((len(weeks) + 1, monday, monday + 6 * ONE_DAY))
+      monday += ONE_WEEK
+    _iso_weeks[year] = weeks
+  return weeks
+
+def week_window(year, week):
+  "Return the first (monday) and last (sunday) date of ISO week in year."
+  number, monday, sunday = iso_weeks(year)[week - 1]
+  return monday, sunday
+
+def easter(year):
+  "Return the date of Easter Sunday in year (Gregorian computus)."
+  a = year % 19
+  b, c = divmod(year, 100)
+  d, e = divmod(b, 4)
+  f = (b + 8) / 25
+  g = (b - f + 1) / 3
+  h = (19 * a + b - d - g + 15) % 30
+  i, k = divmod(c, 4)
+  l = (32 + 2 * e + 2 * i - h - k) % 7
+  m = (a + 11 * h + 22 * l) / 451
+  month, day = divmod(h + l - 7 * m + 114, 31)
+  return datetime.date(year, month, day + 1)
+
+def _weekday_between(year, month, first, weekday):
+  "The date of weekday (0 is Monday) in the week starting with first in month."
+  day = datetime.date(year, month, first)
+  return day + datetime.timedelta(days=(weekday - day.weekday()) % 7)
+
+def swedish_holidays(year):
+  """
+    The Swedish public holidays of year, and the eves that are days off by
+    custom (midsummer, Christmas and New Year's Eve), as {date: name}.
+  """
+  sunday = easter(year)
+  holidays = { datetime.date(year, 1, 1): u"Nyårsdagen",
+               datetime.date(year, 1, 6): u"Trettondedag jul",
+               sunday - 2 * ONE_DAY: u"Långfredagen",
+               sunday: u"Påskdagen",
+               sunday + ONE_DAY: u"Annandag påsk",
+               datetime.date(year, 5, 1): u"Första maj",
+               sunday + 39 * ONE_DAY: u"Kristi himmelsfärdsdag",
+               sunday + 49 * ONE_DAY: u"Pingstdagen",
+               _weekday_between(year, 6, 19, 4): u"Midsommarafton",
+               _weekday_between(year, 6, 20, 5): u"Midsommardagen",
+               _weekday_between(year, 10, 31, 5): u"Alla helgons dag",
+               datetime.date(year, 12, 24): u"Julafton",
+               datetime.date(year, 12, 25): u"Juldagen",
+               datetime.date(year, 12, 26): u"Annandag jul",
+               datetime.date(year, 12, 31): u"Nyårsafton", }
+  if year < 2005:
+    holidays[sunday + 50 * ONE_DAY] = u"Annandag pingst"
+  else:
+    holidays[datetime.date(year, 6, 6)] = u"Sveriges nationaldag"
+  return holidays
+
+def no_holidays(year):
+  return {}
+
+# The holiday rule sets that cfg['holidays'] can name
+HOLIDAYS = { 'swedish': swedish_holidays,
+             'none': no_holidays, }
+
+class WorkCalendar(object):
+  """
+    Working days are Monday to Friday except the holidays, which are given
+    by a rule set: a function from a year to {date: name}. Everything about
+    a year is computed the first time it is asked for.
+  """
+
+  def __init__(self, holidays=swedish_holidays):
+    self.holidays = holidays
+    self._years = {}
+
+  def _year(self, year):
+    "Return (holidays, working days by month, ISO weeks by month) for year."
+    result = self._years.get(year)
+    if result is None:
+      holidays = self.holidays(year)
+      days = {}
+      day = datetime.date(year, 1, 1)
+      while day.year == year:
+        if day.weekday() < 5 and not day in holidays:
+          days[day.month] = days.get(day.month, 0) + 1
+        day += ONE_DAY
+      weeks = {}
+      for week, monday, sunday in iso_weeks(year):
+        thursday = monday + 3 * ONE_DAY  # The ISO rule, a week belongs to the month of its Thursday
+        weeks.setdefault(thursday.month, []).append(week)
+      result = self._years[year] = (holidays, days, weeks)
+    return result
+
+  def is_working_day(self, date):
+    return date.weekday() < 5 and not date in self._year(date.year)[0]
+
+  def working_days(self, year, month):
+    "The number of working days in month."
+    return self._year(year)[1].get(month, 0)
+
+  def month_weeks(self, year, month):
+    "The ISO weeks of year that belong to month, i.e. have their Thursday in it."
+    return self._year(year)[2].get(month, [])
+
+_calendars = {}
+
+def get_calendar(rules=None):
+  "Return the shared WorkCalendar for a holiday rule set, default cfg['holidays']."
+  if rules is None:
+    rules = cfg.get('holidays', 'swedish')
+  if not rules in _calendars:
+    _calendars[rules] = WorkCalendar(HOLIDAYS[rules])
+  return _calendars[rules]
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestCalendars(unittest.TestCase):
+
+  def testIsoCalendar(self):
+    for year in range(1990, 2040):
+      for week, monday, sunday in iso_weeks(year):
+        self.assertEquals((year, week, 1), monday.isocalendar())
+        self.assertEquals((year, week, 7), sunday.isocalendar())
+      last = iso_weeks(year)[-1][2]
+      self.assertEquals((year + 1, 1, 1), (last + ONE_DAY).isocalendar())
+
+  def test2009(self):
+    self.assertEquals((datetime.date(2009, 5, 4), datetime.date(2009, 5, 10)), week_window(2009, 19))
+    self.assertEquals((datetime.date(2008, 12, 29), datetime.date(2009, 1, 4)), week_window(2009, 1))
+    self.assertEquals(53, len(iso_weeks(2009)))
+    self.assertEquals(52, len(iso_weeks(2010)))
+
+  def testCached(self):
+    self.assertTrue(iso_weeks(2011) is iso_weeks(2011))
+    self.assertTrue(get_calendar('swedish') is get_calendar('swedish'))
+
+  def testEaster(self):
+    for year, month, day in ((2000, 4, 23), (2008, 3, 23), (2009, 4, 12), (2010, 4, 4), (2011, 4, 24), (2038, 4, 25)):
+      self.assertEquals(datetime.date(year, month, day), easter(year))
+
+  def testWorkingDays(self):
+    work = WorkCalendar()
+    expected = [20, 20, 22, 20, 19, 21, 23, 21, 22, 22, 21, 20]  # 2009
+    self.assertEquals(expected, [work.working_days(2009, month) for month in range(1, 13)])
+    self.assertFalse(work.is_working_day(datetime.date(2009, 6, 19)))
+    self.assertTrue(work.is_working_day(datetime.date(2009, 6, 22)))
+    weekdays = len([i for i in range(365) if (datetime.date(2009, 1, 1) + i * ONE_DAY).weekday() < 5])
+    self.assertEquals(weekdays, sum([WorkCalendar(no_holidays).working_days(2009, month) for month in range(1, 13)]))
+    self.assertEquals([2009], work._years.keys())
+
+  def testMonthWeeks(self):
+    work = WorkCalendar()
+    self.assertEquals([1, 2, 3, 4, 5], work.month_weeks(2009, 1))
+    self.assertEquals([19, 20, 21, 22], work.month_weeks(2009, 5))
+    self.assertEquals([49, 50, 51, 52, 53], work.month_weeks(2009, 12))
+    for year in range(2000, 2030):
+      weeks = sum([work.month_weeks(year, month) for month in range(1, 13)], [])
+      self.assertEquals(range(1, len(iso_weeks(year)) + 1), weeks)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+columnar.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import datetime
+import os
+import shutil
+import sys
+import json
+import unittest
+
+import numpy
+from sqlalchemy import func, select
+from sqlalchemy.engine.url import make_url
+
+from config import cfg
+from model import *
+import reportcache
+import reporting
+import storage
+
+class TaskColumns(object):
+  """
+    The tasks of a date range as NumPy arrays with one element per task, in
+    id order. The employee, customer, project and task name columns are
+    dictionary encoded, they hold indexes into the lists employees,
+    customers, projects and names.
+  """
+
+  def __init__(self, employees, customers, projects, names, id, employee, customer, project, name, date, hours, billable):
+    self.employees = employees
+    self.customers = customers
+    self.projects = projects
+    self.names = names
+    self.id = id
+    self.employee = employee
+    self.customer = customer
+    self.project = project
+    self.name = name
+    self.date = date
+    self.hours = hours
+    self.billable = billable
+
+  def __len__(self):
+    return len(self.id)
+
+  def select(self, mask):
+    "Return the tasks where mask, a boolean array or index array, is true."
+    return TaskColumns(self.employees, self.customers, self.projects, self.names,
+                       self.id[mask], self.employee[mask], self.customer[mask], self.project[mask],
+                       self.name[mask], self.date[mask], self.hours[mask], self.billable[mask])
+
+  def between(self, start, stop):
+    "Return the tasks from start to stop (inclusive), dates as YYYY-MM-DD."
+    return self.select((self.date >= numpy.datetime64(start)) & (self.date <= numpy.datetime64(stop)))
+
+  def codes(self, labels, values):
+    "Return the codes of values in labels, e.g. codes(tasks.names, cfg['billable'])."
+    values = [_unicode(value) for value in values]
+    return numpy.array([i for i, label in enumerate(labels) if label in values], dtype=numpy.int32)
+
+def load(start, stop):
+  """
+    Load the tasks from start to stop (inclusive) into a TaskColumns. The
+    rows are read with a plain DB-API cursor, the type conversions of
+    SQLAlchemy cost more than the query itself.
+  """
+  t, p, c = Task.table, Project.table, Customer.table
+  sql = "SELECT %(t)s.id, %(t)s.employee_name, %(p)s.customer_id, %(t)s.project_id, %(t)s.name, " \
+        "%(t)s.date, %(t)s.hours, %(t)s.billable FROM %(t)s, %(p)s " \
+        "WHERE %(t)s.date >= ? AND %(t)s.date <= ? AND %(t)s.project_id = %(p)s.id " \
+        "ORDER BY %(t)s.id" % { 't': t.name, 'p': p.name }
+  connection = metadata.bind.raw_connection()
+  try:
+    cursor = connection.cursor()
+    cursor.execute(sql, (str(start), str(stop)))
+    rows = cursor.fetchall()
+  finally:
+    connection.close()
+
+  columns = zip(*rows) or [()] * 8
+  del rows
+  employees, employee = _encode(columns[1])
+  customers, customer = _encode_ids(columns[2], c)
+  projects, project = _encode_ids(columns[3], p)
+  names, name = _encode(columns[4])
+  return TaskColumns(employees, customers, projects, names,
+                     numpy.array(columns[0], dtype=numpy.int64), employee, customer, project, name,
+                     numpy.array(columns[5], dtype='datetime64[D]'),
+                     numpy.array(columns[6], dtype=numpy.float64),
+                     numpy.array(columns[7], dtype=numpy.bool_))
+
+def _unicode(value):
+  if isinstance(value, str):
+    return unicode(value, 'utf-8')
+  return value
+
+def _encode(values):
+  "Dictionary encode values, return the labels and the array of codes."
+  codes = {}
+  array = numpy.array([codes.setdefault(value, len(codes)) for value in values], dtype=numpy.int32)
+  labels = [None] * len(codes)
+  for value, code in codes.items():
+    labels[code] = _unicode(value)
+  return labels, array
+
+def _encode_ids(ids, table):
+  "Encode the ids of rows in table, the labels are their names."
+  keys, array = numpy.unique(numpy.array(ids, dtype=numpy.int64), return_inverse=True)
+  names = dict([(row[0], row[1]) for row in session.execute(select([table.c.id, table.c.name]))])
+  return [names[key] for key in keys], array.astype(numpy.int32)
+
+def group_sum(values, *keys):
+  """
+    Sum values grouped by one or more code arrays. Returns the unique keys,
+    one array per key column, and the sums in the order of the keys.
+  """
+  if not len(values):
+    return tuple([numpy.zeros(0, dtype=numpy.int32) for key in keys]), numpy.zeros(0)
+  sizes = [int(key.max()) + 1 for key in keys]
+  combined = numpy.zeros(len(values), dtype=numpy.int64)
+  for key, size in zip(keys, sizes):
+    combined = combined * size + key
+  if numpy.prod(sizes, dtype=numpy.float64) <= 4 * len(values):
+    # Few possible groups, count them all without sorting
+    unique = numpy.flatnonzero(numpy.bincount(combined))
+    sums = numpy.bincount(combined, weights=values)[unique]
+  else:
+    unique, inverse = numpy.unique(combined, return_inverse=True)
+    sums = numpy.bincount(inverse, weights=values)
+  result = []
+  for size in reversed(sizes):
+    result.insert(0, (unique % size).astype(numpy.int32))
+    unique = unique // size
+  return tuple(result), sums
+
+def hours_by_name(tasks, employee):
+  """
+    The hours of an employee summed by task name, the same dict as
+    Statistics.by_employee() returns for the range of tasks.
+  """
+  code = tasks.employees.index(_unicode(employee))
+  mask = tasks.employee == code
+  (names,), sums = group_sum(tasks.hours[mask], tasks.name[mask])
+  return dict([(tasks.names[name], hours) for name, hours in zip(names, sums)])
+
+def billing_ratios(tasks, available):
+  """
+    The billing figures of every employee the way MonthlyReport computes
+    them for a month: the hours of cfg['billable'] tasks, the available
+    hours (available for a full-time employee, scaled by cfg['parttime'],
+    minus the hours of cfg['absence'] tasks) and the ratio in percent.
+    Returns (billable, available, ratio) arrays indexed by employee code.
+  """
+  count = len(tasks.employees)
+  billable = numpy.bincount(tasks.employee, weights=tasks.hours * numpy.in1d(tasks.name, tasks.codes(tasks.names, cfg['billable'])), minlength=count)
+  absence = numpy.bincount(tasks.employee, weights=tasks.hours * numpy.in1d(tasks.name, tasks.codes(tasks.names, cfg['absence'])), minlength=count)
+  parttime = numpy.array([cfg['parttime'].get(employee.encode("utf-8"), 1) for employee in tasks.employees], dtype=numpy.float64)
+  available = available * parttime - absence
+  return billable, available, billable / available * 100
+
+def task_rows(tasks):
+  "Return the tasks as a list of reporting.TaskRow, e.g. for MonthlyReport.rows."
+  employees, customers, projects, names = tasks.employees, tasks.customers, tasks.projects, tasks.names
+  return [reporting.TaskRow(id, employees[employee], customers[customer], projects[project], names[name], date, hours, billable)
+          for id, employee, customer, project, name, date, hours, billable
+          in zip(tasks.id.tolist(), tasks.employee.tolist(), tasks.customer.tolist(), tasks.project.tolist(),
+                 tasks.name.tolist(), tasks.date.tolist(), tasks.hours.tolist(), tasks.billable.tolist())]
+
+
+# Snapshots
+#
+# A snapshot is a directory with a subdirectory per month, YYYY-MM, that
+# holds the month's TaskColumns as one .npy file per column and the labels
+# in labels.json. The .npy files are not compressed so that they can be
+# memory-mapped. state.json holds the id of the last task in the snapshot
+# and the ChangeCounter.tasks it was written at.
+
+COLUMNS = ('id', 'employee', 'customer', 'project', 'name', 'date', 'hours', 'billable')
+DTYPES = (numpy.int64, numpy.int32, numpy.int32, numpy.int32, numpy.int32, 'datetime64[D]', numpy.float64, numpy.bool_)
+LABELS = ('employees', 'customers', 'projects', 'names')
+
+def snapshot_path():
+  """
+    The snapshot directory of the bound SQLite DB, next to it, or to the
+    file a memory DB was loaded from (see storage.py). None for in-memory DBs.
+  """
+  database = make_url(storage.source_url(metadata.bind)).database
+  if not database or database == ":memory:":
+    return None
+  return os.path.splitext(database)[0] + ".columns"
+
+def _state(directory):
+  "The last task and the ChangeCounter.tasks of the snapshot in directory."
+  path = os.path.join(directory, "state.json")
+  if not os.path.exists(path):
+    return 0, 0
+  state = json.load(file(path))
+  return state['last_task'], state.get('tasks', 0)
+
+def _max_task():
+  return session.execute(select([func.max(Task.table.c.id)])).scalar() or 0
+
+def is_current(directory):
+  """
+    True if the snapshot in directory is up to date with the tasks in the
+    DB, i.e. no task has been inserted, updated or deleted since it was
+    written (see ChangeCounter.tasks).
+  """
+  return directory is not None and _state(directory) == (_max_task(), reportcache.task_changes())
+
+def write_snapshot(directory):
+  """
+    Bring the snapshot in directory up to date. If only tasks have been
+    added since it was last written, only their months are written again,
+    otherwise all of them. The directory is created if it does not exist.
+    Returns the months that were written.
+  """
+  t = Task.table
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  last, counted = _state(directory)
+  newest = _max_task()
+  changes = reportcache.task_changes()
+  if (newest, changes) == (last, counted):
+    return []
+  added = session.execute(select([func.count(t.c.id)], t.c.id > last)).scalar()
+  if counted + added != changes:
+    for name in os.listdir(directory):
+      if len(name) == 7:
+        shutil.rmtree(os.path.join(directory, name))
+    last = 0
+  q = select([func.substr(t.c.date, 1, 7)], t.c.id > last, distinct=True)
+  months = [str(row[0]) for row in session.execute(q)]
+  months.sort()
+  for month in months:
+    _save(os.path.join(directory, month), load("%s-01" % month, _month_stop(month)))
+  state = file(os.path.join(directory, "state.json"), "w")
+  json.dump({'last_task': newest, 'tasks': changes}, state)
+  state.close()
+  return months
+
+def _month_stop(month):
+  "The last day of month, YYYY-MM, as YYYY-MM-DD."
+  year, number = [int(x) for x in month.split("-")]
+  return str(datetime.date(year + number / 12, number % 12 + 1, 1) - datetime.timedelta(days=1))
+
+def _save(path, tasks):
+  "Write tasks to path, replacing an older version of it."
+  tmp = path + ".tmp"
+  if os.path.exists(tmp):
+    shutil.rmtree(tmp)
+  os.makedirs(tmp)
+  for column in COLUMNS:
+    numpy.save(os.path.join(tmp, column + ".npy"), getattr(tasks, column))
+  labels = file(os.path.join(tmp, "labels.json"), "w")
+  json.dump(dict([(name, getattr(tasks, name)) for name in LABELS]), labels)
+  labels.close()
+  if os.path.exists(path):
+    shutil.rmtree(path)
+  os.rename(tmp, path)
+
+def _open(path):
+  "Memory-map the TaskColumns of a month in a snapshot."
+  labels = json.load(file(os.path.join(path, "labels.json")))
+  arrays = [numpy.load(os.path.join(path, column + ".npy"), mmap_mode='r') for column in COLUMNS]
+  return TaskColumns(*([labels[name] for name in LABELS] + arrays))
+
+def read_snapshot(directory, start, stop):
+  """
+    Return the tasks from start to stop (inclusive, datetime.date or
+    YYYY-MM-DD) from the snapshot in directory. A single month is returned
+    memory-mapped, the months of a longer range are merged.
+  """
+  start, stop = str(start), str(stop)
+  months = [name for name in os.listdir(directory) if len(name) == 7 and start[:7] <= name <= stop[:7]]
+  months.sort()
+  parts = [_open(os.path.join(directory, month)) for month in months]
+  if len(parts) == 1 and start <= months[0] + "-01" and stop >= _month_stop(months[0]):
+    return parts[0]
+  return _merge(parts).between(start, stop)
+
+def _merge(parts):
+  "Concatenate TaskColumns in id order, the codes are mapped to merged label lists."
+  labels = dict([(name, []) for name in LABELS])
+  codes = dict([(name, {}) for name in LABELS])
+  remapped = dict([(column, []) for column in COLUMNS])
+  for part in parts:
+    for name, column in zip(LABELS, ('employee', 'customer', 'project', 'name')):
+      mapping = []
+      for label in getattr(part, name):
+        if not label in codes[name]:
+          codes[name][label] = len(labels[name])
+          labels[name].append(label)
+        mapping.append(codes[name][label])
+      remapped[column].append(numpy.array(mapping, dtype=numpy.int32)[getattr(part, column)])
+    for column in ('id', 'date', 'hours', 'billable'):
+      remapped[column].append(getattr(part, column))
+  if not parts:
+    return TaskColumns(*([[]] * 4 + [numpy.zeros(0, dtype=dtype) for dtype in DTYPES]))
+  tasks = TaskColumns(*([labels[name] for name in LABELS] + [numpy.concatenate(remapped[column]) for column in COLUMNS]))
+  return tasks.select(numpy.argsort(tasks.id, kind='mergesort'))  # Tasks are not added in date order
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class ColumnarTestCase(unittest.TestCase):
+  "Loads the test data into an in-memory DB."
+
+  def setUp(self):
+    from mapper import CSVDBMapper
+    from statistics_month import DateModel
+    self.DATAFILE = "testdata/testdata.csv"
+    self.bind = metadata.bind
+    metadata.bind = "sqlite:///:memory:"
+    create_all()
+    CSVDBMapper(self.DATAFILE).map()
+    session.clear()
+    first = Task.query.order_by(Task.date).first()
+    self.start = "%d-%02d-01" % (first.date.year, first.date.month)
+    self.stop = DateModel(self.start).get_month_stop()
+    session.clear()
+
+  def tearDown(self):
+    session.close()
+    drop_all()
+    metadata.bind = self.bind
+
+class TestColumnar(ColumnarTestCase):
+
+  def testLoad(self):
+    tasks = load(self.start, self.stop)
+    rows = reporting.task_rows(self.start, self.stop)
+    self.assertEquals(len(rows), len(tasks))
+    for i, row in enumerate(rows):
+      self.assertEquals((row.id, row.employee, row.customer, row.project, row.name, str(row.date), row.hours, bool(row.billable)),
+                        (tasks.id[i], tasks.employees[tasks.employee[i]], tasks.customers[tasks.customer[i]],
+                         tasks.projects[tasks.project[i]], tasks.names[tasks.name[i]], str(tasks.date[i]),
+                         tasks.hours[i], tasks.billable[i]))
+
+  def testBetween(self):
+    tasks = load("2000-01-01", "2099-12-31")
+    self.assertEquals(len(load(self.start, self.stop)), len(tasks.between(self.start, self.stop)))
+
+  def testHoursByName(self):
+    from statistics_month import Statistics, DateModel
+    tasks = load(self.start, self.stop)
+    stats = Statistics(DateModel(self.start))
+    for employee in tasks.employees:
+      expected = stats._aggregate_tasks(reporting.task_rows(self.start, self.stop, employee))
+      actual = hours_by_name(tasks, employee)
+      self.assertEquals(sorted(expected.keys()), sorted(actual.keys()))
+      for name in expected.keys():
+        self.assertAlmostEquals(expected[name], actual[name])
+
+  def testBillingRatios(self):
+    import imp
+    report = imp.load_source("monthly_report", "monthly-report.py").MonthlyReport(self.start[:7])
+    report.get_report()
+    total_time, total_billable, offices = report.totals
+    tasks = load(self.start, self.stop)
+    billable, available, ratio = billing_ratios(tasks, report.workdays * 8)
+    self.assertAlmostEquals(total_billable, billable.sum())
+    self.assertAlmostEquals(total_time, available.sum())
+
+  def testGroupSum(self):
+    tasks = load(self.start, self.stop)
+    (employees, names), sums = group_sum(tasks.hours, tasks.employee, tasks.name)
+    self.assertAlmostEquals(tasks.hours.sum(), sums.sum())
+    for employee, name, hours in zip(employees, names, sums):
+      mask = (tasks.employee == employee) & (tasks.name == name)
+      self.assertAlmostEquals(tasks.hours[mask].sum(), hours)
+
+class TestSnapshot(ColumnarTestCase):
+
+  def setUp(self):
+    import tempfile
+    ColumnarTestCase.setUp(self)
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    ColumnarTestCase.tearDown(self)
+
+  def testRoundTrip(self):
+    self.assertFalse(is_current(self.directory))
+    months = write_snapshot(self.directory)
+    self.assertTrue(self.start[:7] in months)
+    self.assertTrue(is_current(self.directory))
+    self.assertEquals([], write_snapshot(self.directory))
+    for start, stop in ((self.start, self.stop), (self.start, "2099-12-31"), (self.start[:8] + "10", self.stop)):
+      self.assertEquals(reporting.task_rows(start, stop), task_rows(read_snapshot(self.directory, start, stop)))
+
+  def testIncremental(self):
+    write_snapshot(self.directory)
+    task = Task.query.first()
+    session.execute(Task.table.insert(), {'name': task.name, 'date': datetime.date(2009, 12, 24), 'hours': 1.0,
+                                          'employee_name': task.employee.name, 'project_id': task.project.id})
+    self.assertFalse(is_current(self.directory))
+    self.assertEquals(["2009-12"], write_snapshot(self.directory))
+    self.assertEquals(1, len(read_snapshot(self.directory, "2009-12-01", "2009-12-31")))
+
+  def testChanged(self):
+    write_snapshot(self.directory)
+    task = Task.query.order_by(Task.id.desc()).first()
+    session.execute(Task.table.update(Task.table.c.id == task.id), {'hours': task.hours + 1})
+    session.commit()
+    self.assertFalse(is_current(self.directory))
+    self.assertTrue(str(task.date)[:7] in write_snapshot(self.directory))
+    self.assertTrue(is_current(self.directory))
+    session.execute(Task.table.delete(Task.table.c.id == task.id))
+    session.commit()
+    self.assertFalse(is_current(self.directory))
+    write_snapshot(self.directory)
+    self.assertEquals(reporting.task_rows(self.start, "2099-12-31"), task_rows(read_snapshot(self.directory, self.start, "2099-12-31")))
+
+  def testChangedWithoutDirectory(self):
+    task = Task.query.first()
+    session.execute(Task.table.update(Task.table.c.id == task.id), {'hours': task.hours + 1})
+    session.commit()
+    directory = os.path.join(self.directory, "new")
+    self.assertTrue(str(task.date)[:7] in write_snapshot(directory))
+    self.assertTrue(is_current(directory))
+
+  def testMonthlyReport(self):
+    import imp
+    write_snapshot(self.directory)
+    report = imp.load_source("monthly_report", "monthly-report.py").MonthlyReport(self.start[:7])
+    expected = report.get_report()
+    first, last = report.span()
+    report.rows = task_rows(read_snapshot(self.directory, first, last))
+    self.assertEquals(expected, report.get_report())
+
+@unittest.skipUnless(os.environ.get('HARVEST_BENCH'), "set HARVEST_BENCH=1 to run the benchmarks")
+class BenchColumnar(unittest.TestCase):
+  "Not a test, times the aggregation of a million tasks."
+
+  def testAggregate(self):
+    import time
+    rnd = numpy.random.RandomState(1)
+    count = 1000000
+    tasks = TaskColumns([u"Employee %d" % i for i in range(200)], [u"Customer"], [u"Project"], [u"Task %d" % i for i in range(8)],
+                        numpy.arange(count), rnd.randint(0, 200, count).astype(numpy.int32), numpy.zeros(count, dtype=numpy.int32),
+                        numpy.zeros(count, dtype=numpy.int32), rnd.randint(0, 8, count).astype(numpy.int32),
+                        numpy.zeros(count, dtype='datetime64[D]'), rnd.choice([1.0, 2.5, 8.0], count), numpy.zeros(count, dtype=numpy.bool_))
+    ts = time.time()
+    group_sum(tasks.hours, tasks.employee, tasks.name)
+    hours_by_name(tasks, u"Employee 7")
+    billing_ratios(tasks, 160)
+    elapsed = time.time() - ts
+    print >> sys.stderr, "\nAggregated %d tasks in %0.1f ms" % (count, elapsed * 1000)
+
+
+if __name__ == "__main__":
+  unittest.main()
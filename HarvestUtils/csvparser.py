@@ -22,85 +22,120 @@ You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import csv
 import inspect
 import logging
 import os
+import sys
+import threading
 import time
 import unittest
 
 log = logging.getLogger("csvparser")
 
+_arity = {}
+
+def arity(cls):
+  """
+    Return the number of arguments to pass to the constructor of cls (-1
+    for self). The result is cached per class.
+  """
+  if not cls in _arity:
+    _arity[cls] = len(inspect.getargspec(cls.__init__)[0]) - 1
+  return _arity[cls]
+
 class CSVFile(object):
   """
     This class represents a generic CSV-file and parses the file line by line.
+    Fields are parsed with the csv module, so quoted fields may contain
+    commas, quotes and line breaks (RFC 4180). Lines with the wrong number of
+    fields are skipped and counted in self.rejected.
+    Reading and writing use separate file handles, serialize() appends to the
+    end of the file and the appended lines can then be read with next().
     @param filepath is the path to the file
     @param clz is the class that should be instansiated with the parsed values
     @param skip_header is a boolean that is true if the first line is a 
            header and should be skipped
   """
   
-  READ = 'r'
-  WRITE = 'w'
+  READ = 'rb'
+  WRITE = 'ab'
+  BUFSIZE = 1024 * 1024
   
   def __init__(self,filepath,cls,skip_header=True):
-    self.file = self._open(filepath,None) 
+    self.path = filepath
     self.cls = cls
-    # Determine the number of arguments to pass to the constructor (-1 for
-    # self)
-    self.length = len(inspect.getargspec(self.cls.__init__)[0]) - 1
-    if skip_header:
-      self.header = self.file.readline()
-      log.debug("skip_header is True, throwing away: '%s'" % self.header)
+    self.length = arity(cls)
+    self.skip_header = skip_header
+    self.header = None
     self.lineno = 0
+    self.rejected = 0
+    self.infile = None
+    self.reader = None
+    self.outfile = None
+    self.writer = None
+    self.debug = log.isEnabledFor(logging.DEBUG)
+    if os.path.exists(filepath):
+      self._open_reader()
 
   def next(self):
-    self._open(self.file.name, CSVFile.READ)  # Just a check that we are in read-mode and at the right position.
-    line = unicode(self.file.readline(), 'utf-8')
-    if line:
+    if self.reader is None:
+      self._open_reader()
+    length = self.length
+    while True:
+      try:
+        row = self.reader.next()
+      except StopIteration:
+        log.debug("CSVFile.next() reached end of file")
+        if self.rejected > 0:
+          log.warning("Rejected %d of %d lines in %s", self.rejected, self.lineno, self.path)
+        raise
+      except csv.Error, e:
+        self.lineno+=1
+        self._reject("line %d: %s" % (self.lineno, e))
+        continue
+      if not row:
+        continue  # Empty line
       self.lineno+=1
-      log.debug("CSVFile.next(): parsing line '%s'" % line.strip())
-      return self._parse_line(line.strip())
-    else:
-      log.debug("CSVFile.next() reached end of file, starting from top next time")
-      raise StopIteration
+      if self.debug:
+        log.debug("CSVFile.next(): parsing line %d %r", self.lineno, row)
+      if len(row) == length:
+        return self.cls(*[unicode(x, 'utf-8').strip() for x in row])
+      self._reject("number of parsed tokens is not equal to the predetermined number of tokens (%d,%d), line %d: '%s'" % (len(row), length, self.lineno, ",".join(row)))
 
   def serialize(self,*args):
-    self._open(self.file.name, CSVFile.WRITE)
-    str = ""
-    for arg in args:
-      str = str + "%s," %arg
-    str = str.rstrip(",")
-    self.file.write("%s\n" % str)
-    return str
+    if self.writer is None:
+      self.outfile = file(self.path, CSVFile.WRITE, CSVFile.BUFSIZE)
+      self.writer = csv.writer(self.outfile, lineterminator="\n")
+    args = [self._encode(arg) for arg in args]
+    self.writer.writerow(args)
+    self.outfile.flush()  # Make the line visible to the reader
+    if self.infile is not None:
+      self.infile.seek(0, 1)  # and clear its end of file state
+    return ",".join(args)
+
+  def _open_reader(self):
+    self.infile = file(self.path, CSVFile.READ, CSVFile.BUFSIZE)
+    if self.skip_header:
+      self.header = self.infile.readline()
+      log.debug("skip_header is True, throwing away: '%s'", self.header)
+    self.reader = csv.reader(self.infile)
+
+  def _reject(self,reason):
+    self.rejected+=1
+    log.warning("Throwing away %s", reason)
+
+  def _encode(self,arg):
+    if isinstance(arg, unicode):
+      return arg.encode('utf-8')
+    return "%s" % arg
     
-  def _parse_line(self,line):
-    args = line.split(",")
-    args = [x.strip() for x in args]
-    if not len(args) == self.length:
-      log.warning("Number of parsed tokens is not equal to the predetermined number of tokens (%d,%d), line %d" % (len(args),self.length, self.lineno))
-      log.warning("Throwing away line '%s'" % line)
-      return self.next()
-    else:
-      return self.cls(*tuple(args))
-
   def _setoflines(self):
-    curr = self.file.tell()
-    self.file.seek(0)
-    lines = [x.strip() for x in self.file.readlines()]
-    self.file.seek(curr)
+    handle = file(self.path, CSVFile.READ)
+    lines = [x.strip() for x in handle.readlines()]
+    handle.close()
     return set(lines)
 
-  def _open(self,filepath,mode):
-    if mode is None:
-      if os.path.exists(filepath):
-        mode = CSVFile.READ
-      else:
-        mode = CSVFile.WRITE
-      return file(filepath, mode)
-    else:
-      if not self.file.mode == mode:
-        self.file = file(filepath,mode)
-
   def __iter__(self):
     return self
 
@@ -111,6 +146,126 @@ class CSVFile(object):
       return self._setoflines() - other._setoflines()
 
 
+def split_ranges(filepath, parts, skip_header=True):
+  """
+    Split a file into at most parts byte ranges that start and end at line
+    boundaries. Returns a list of (start, stop) offsets, the header line is
+    not part of any range if skip_header is True.
+    NOTE: A quoted field with line breaks may be split in two ranges, those
+    two lines are then rejected by the parser.
+  """
+  size = os.path.getsize(filepath)
+  handle = file(filepath, 'rb')
+  start = 0
+  if skip_header:
+    handle.readline()
+    start = handle.tell()
+  step = max((size - start) / max(parts, 1), 1)
+  ranges = []
+  while start < size:
+    handle.seek(start + step)
+    handle.readline()  # Move forward to the next line boundary
+    stop = min(handle.tell(), size)
+    ranges.append((start, stop))
+    start = stop
+  handle.close()
+  return ranges
+
+def _parse_range(filepath, length, start, stop):
+  """
+    Parse the lines in the byte range [start, stop) of a file. Used by the
+    worker processes of ParallelCSVFile, returns the rows with the right
+    number of fields as tuples and the number of rejected lines.
+  """
+  handle = file(filepath, 'rb')
+  handle.seek(start)
+  lines = handle.read(stop - start).splitlines(True)
+  handle.close()
+  rows = []
+  rejected = 0
+  reader = csv.reader(lines)
+  while True:
+    try:
+      row = reader.next()
+    except StopIteration:
+      break
+    except csv.Error:
+      rejected+=1
+      continue
+    if len(row) == length:
+      rows.append(tuple([unicode(x, 'utf-8').strip() for x in row]))
+    elif row:
+      rejected+=1
+  return rows, rejected
+
+def _parse_job(job):
+  "_parse_range() for Pool.imap(), job is its arguments as a tuple."
+  return _parse_range(*job)
+
+class ParallelCSVFile(object):
+  """
+    Parses a large CSV file in worker processes. The file is split into byte
+    ranges of about CHUNKSIZE bytes at line boundaries (see split_ranges())
+    which are parsed by a pool of jobs processes. The parsed rows come back
+    as batches of tuples and are turned into cls instances in the original
+    order when iterating. At most 2 * jobs batches are in flight, so the
+    whole file is never held in memory.
+    @param filepath is the path to the file
+    @param cls is the class that should be instansiated with the parsed values
+    @param jobs is the number of worker processes
+    @param skip_header is a boolean that is true if the first line is a 
+           header and should be skipped
+    @param pool is an optional multiprocessing Pool to parse in, it can be
+           shared by several files. A pool of jobs processes is created for
+           each iteration if it is None.
+  """
+
+  CHUNKSIZE = 16 * 1024 * 1024
+
+  def __init__(self,filepath,cls,jobs,skip_header=True,pool=None):
+    self.path = filepath
+    self.cls = cls
+    self.jobs = jobs
+    self.pool = pool
+    self.length = arity(cls)
+    self.lineno = 0
+    self.rejected = 0
+    parts = max(jobs, os.path.getsize(filepath) / ParallelCSVFile.CHUNKSIZE)
+    self.ranges = split_ranges(filepath, parts, skip_header)
+
+  def __iter__(self):
+    cls = self.cls
+    pool = self.pool
+    if pool is None:
+      from multiprocessing import Pool
+      pool = Pool(self.jobs)
+    # Pool.imap() takes the ranges from jobs() in a thread of the pool, the
+    # window keeps it from getting more than 2 * jobs batches ahead
+    window = threading.Semaphore(2 * self.jobs)
+    stopped = []
+    def jobs():
+      for start, stop in self.ranges:
+        window.acquire()
+        if stopped:
+          return
+        yield (self.path, self.length, start, stop)
+    try:
+      for rows, rejected in pool.imap(_parse_job, jobs()):
+        window.release()
+        self.lineno += len(rows) + rejected
+        self.rejected += rejected
+        for row in rows:
+          yield cls(*row)
+    finally:
+      stopped.append(True)
+      window.release()  # In case jobs() waits for a batch that is never taken
+      if self.pool is None:
+        pool.terminate()
+        pool.join()
+    if self.rejected > 0:
+      log.warning("Rejected %d of %d lines in %s", self.rejected, self.lineno, self.path)
+
+
 
 # Unit test cases below this line
 #----------------------------------------------------------------------------
@@ -130,6 +285,12 @@ class TestEntry(object):
       num+=1
       print "- %d: '%s'" % (num,arg) 
 
+class HarvestEntry(object):
+  def __init__(self,date,customer,project,project_code,task,note,hours,first_name,last_name,billable,evsc,approved,rate,cost,department):
+    self.date = date
+    self.note = note
+    self.hours = hours
+
 class Dummy(object):
   def __init__(self,a,b,c):
     self.a = a
@@ -177,6 +338,63 @@ class TestCSVFile(unittest.TestCase):
     self.assertEquals("2", first.b)
     self.assertEquals("2", first.c)
 
+  def testQuoting(self):
+    csvtest = CSVFile(self.OUTPUT, Dummy, skip_header=False)
+    csvtest.serialize("a, b", 'say "hi"', "c")
+    csvtest.outfile.write("1,2\n4,5,6\n")
+    csvtest.outfile.flush()
+    first = csvtest.next()
+    self.assertEquals("a, b", first.a)
+    self.assertEquals('say "hi"', first.b)
+    second = csvtest.next()
+    self.assertEquals("4", second.a)
+    self.assertEquals(1, csvtest.rejected)
+
+  def testManyRejected(self):
+    handle = file(self.OUTPUT, 'w')
+    for i in range(5000):
+      handle.write("1,2\n")
+    handle.write("1,2,3\n")
+    handle.close()
+    csvtest = CSVFile(self.OUTPUT, Dummy, skip_header=False)
+    self.assertEquals("3", csvtest.next().c)
+    self.assertEquals(5000, csvtest.rejected)
+
+  def testParallel(self):
+    handle = file(self.OUTPUT, 'w')
+    handle.write("a,b,c\n")
+    for i in range(1000):
+      handle.write('%d,"x, y",z\n' % i)
+      if i % 100 == 0:
+        handle.write("bad line\n")
+    handle.close()
+    ranges = split_ranges(self.OUTPUT, 14)
+    self.assertTrue(1 < len(ranges) <= 14)
+    self.assertEquals(os.path.getsize(self.OUTPUT), ranges[-1][1])
+    expected = [(d.a, d.b, d.c) for d in CSVFile(self.OUTPUT, Dummy)]
+    parallel = ParallelCSVFile(self.OUTPUT, Dummy, 4)
+    self.assertEquals(expected, [(d.a, d.b, d.c) for d in parallel])
+    self.assertEquals(10, parallel.rejected)
+
+  def testSharedPool(self):
+    from multiprocessing import Pool
+    handle = file(self.OUTPUT, 'w')
+    handle.write("a,b,c\n")
+    for i in range(1000):
+      handle.write("%d,b,c\n" % i)
+    handle.close()
+    expected = [d.a for d in CSVFile(self.OUTPUT, Dummy)]
+    pool = Pool(2)
+    try:
+      first = iter(ParallelCSVFile(self.OUTPUT, Dummy, 2, pool=pool))
+      first.next()
+      first.close()  # Stops in the middle of the file
+      for i in range(2):
+        self.assertEquals(expected, [d.a for d in ParallelCSVFile(self.OUTPUT, Dummy, 2, pool=pool)])
+    finally:
+      pool.close()
+      pool.join()
+
   def testDiff(self):
     self.TESTA = "./testdata/test_a"
     self.TESTB = "./testdata/test_b"
@@ -203,6 +421,36 @@ class TestCSVFile(unittest.TestCase):
     f = c.next()
     self.assertEquals('6', f.a)
 
+@unittest.skipUnless(os.environ.get('HARVEST_BENCH'), "set HARVEST_BENCH=1 to run the benchmarks")
+class BenchCSVFile(unittest.TestCase):
+  """
+    Micro-benchmark, parses a synthetic Harvest file and reports lines/sec.
+  """
+
+  LINES = 1000000
+
+  def setUp(self):
+    self.DATAFILE = "./testdata/%s-bench.csv" % time.strftime("%Y-%m-%d_%H%M%S", time.localtime())
+    handle = file(self.DATAFILE, 'w')
+    handle.write("Date,Client,Project,Project Code,Task,Notes,Hours,First Name,Last Name,Billable?,Employee?,Approved,Hourly Rate,Cost,Department\n")
+    line = '2009-05-%02d,Customer,Project,,Development,"Worked on X, Y and Z",7.50,First,Last,billable,employee,yes,0.0,0.0,Development\n'
+    for i in xrange(self.LINES):
+      handle.write(line % (i % 28 + 1))
+    handle.close()
+
+  def tearDown(self):
+    if os.path.exists(self.DATAFILE):
+      os.unlink(self.DATAFILE)
+
+  def testLinesPerSecond(self):
+    ts = time.time()
+    lines = 0
+    for entry in CSVFile(self.DATAFILE, HarvestEntry):
+      lines+=1
+    elapsed = time.time() - ts
+    print >> sys.stderr, "\nCSVFile: %d lines in %0.2f seconds, %d lines/sec" % (lines, elapsed, lines / elapsed)
+    self.assertEquals(self.LINES, lines)
+
 
 if __name__ == "__main__":
   logging.basicConfig(level=logging.ERROR,format='%(asctime)s %(levelname)s %(message)s')
@@ -21,5 +21,10 @@
 # along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# The scripts need Python 2.7, the eggs were built for 2.5 but run on it
+if ! python -c 'import sys; sys.exit(sys.version_info[:2] != (2, 7))' 2>/dev/null; then
+  echo "HarvestUtils needs Python 2.7 as 'python'" >&2
+fi
+
 # Add the required Eggs
 export PYTHONPATH=./deps/Elixir-0.6.0-py2.5.egg:./deps/SQLAlchemy-0.4.7p1-py2.5.egg
\ No newline at end of file
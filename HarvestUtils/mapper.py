@@ -22,21 +22,196 @@ You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 import logging
+import os
 import time
+import unittest
 
 from config import cfg
 from csvparser import CSVFile
 from model import *
+import profiling
+import reportcache
+import rollup
+from sqlalchemy import select
+from sqlalchemy.orm import class_mapper
 
 log = logging.getLogger("mapper")
 
+class LookupCache(object):
+  """
+    A per-run identity cache for the entities the mappers look up by name.
+    Each kind of entity is loaded from the DB with one query the first time
+    it is needed, after that a lookup is a dictionary access. A miss means
+    that the entity did not exist and had to be created.
+  """
+
+  def __init__(self):
+    self.hits = 0
+    self.misses = 0
+    self._customers = None
+    self._projects = None
+    self._employees = None
+    self._offices = None
+    self._members = None
+
+  def customer(self, name):
+    if self._customers is None:
+      self._customers = self._by_name(Customer.query.order_by(Customer.id))
+    customer = self._customers.get(name)
+    if customer is None:
+      self.misses+=1
+      customer = self._customers[name] = Customer(name=name)
+    else:
+      self.hits+=1
+    return customer
+
+  def project(self, customer, name):
+    if self._projects is None:
+      self._projects = {}
+      for project in Project.query.order_by(Project.id):
+        if project.customer is not None:
+          self._projects.setdefault((project.customer.name, project.name), project)
+    project = self._projects.get((customer.name, name))
+    if project is None:
+      self.misses+=1
+      project = self._projects[(customer.name, name)] = Project(name=name)
+      customer.projects.append(project)
+    else:
+      self.hits+=1
+    return project
+
+  def employee(self, name):
+    if self._employees is None:
+      self._employees = self._by_name(Employee.query.all())
+    employee = self._employees.get(name)
+    if employee is None:
+      self.misses+=1
+      employee = self._employees[name] = Employee(name=name)
+    else:
+      self.hits+=1
+    return employee
+
+  def office(self, name):
+    if self._offices is None:
+      self._offices = self._by_name(Office.query.order_by(Office.id))
+    office = self._offices.get(name)
+    if office is None:
+      self.misses+=1
+      office = self._offices[name] = Office(name=name)
+    else:
+      self.hits+=1
+    return office
+
+  def add_member(self, project, employee):
+    "Add employee to project unless it is already a member."
+    if self._members is None:
+      projects = dict([(p.id, p) for p in Project.query.all()])
+      employees = dict([(e.name, e) for e in Employee.query.all()])
+      secondary = class_mapper(Project).get_property('employees').secondary
+      self._members = set()
+      for project_id, employee_name in secondary.select().execute():
+        self._members.add((projects[project_id], employees[employee_name]))
+    if not (project, employee) in self._members:
+      project.employees.append(employee)
+      self._members.add((project, employee))
+
+  def _by_name(self, query):
+    result = {}
+    for entity in query:
+      result.setdefault(entity.name, entity)
+    return result
+
+
 class Mapper(object):
+  """
+    Base class for all mappers. Subclasses set ENTRY to the class of the
+    entries in their CSV files and implement _map_entry() which is called
+    once for every entry. The entries are committed in batches of
+    cfg['batchsize'] rows, a batch size of 0 means that everything is
+    committed in one transaction at the end.
+    @param csvfile is the path to the CSV file
+    @param entries is an optional iterable of already parsed entries from
+           csvfile, the file is parsed by the mapper if it is None
+  """
+
+  ENTRY = None
   
-  def __init__(self, csvfile):
-    pass
+  def __init__(self, csvfile, entries=None):
+    if entries is None:
+      entries = CSVFile(csvfile, self.ENTRY)
+    self.csv = entries
+    self.done = False
+    self.batchsize = cfg.get('batchsize', 1000)
+    self.cache = None
   
   def map(self):
+    if not self.done:
+      ts = time.time()
+      entries = 0
+      skipped = 0
+      pending = 0
+      self.cache = LookupCache()
+      profiler = profiling.current()
+      for batch in self._batches():
+        profiler.begin("dedupe")
+        new = self._new_entries(batch)
+        profiler.end(len(batch))
+        skipped += len(batch) - len(new)
+        profiler.begin("map")
+        for entry in new:
+          log.debug("Updating record (%d) %s", entries, entry)
+          self._map_entry(entry)
+          entries+=1
+        profiler.end(len(new))
+        pending += len(new)
+        if self.batchsize > 0:
+          profiler.begin("commit")
+          self._commit()
+          profiler.end(pending)
+          pending = 0
+      profiler.begin("commit")
+      self._commit()
+      if entries > 0:
+        # After the entries are committed, or a report could be cached
+        # from half an import under the new count
+        reportcache.bump_changes()
+        session.commit()
+      profiler.end(pending)
+
+      elapsed = time.time() - ts
+      log.info("It took %d seconds to update %d entries (%0.1f rows/sec, %d cache hits, %d misses)." % (elapsed, entries, entries / max(elapsed, 0.001), self.cache.hits, self.cache.misses))
+      if skipped > 0:
+        log.info("Skipped %d entries that already were in the DB." % skipped)
+      self.done = True
+    else:
+      pass
+
+  def _batches(self):
+    "Yield the entries of the CSV file in lists of (at most) batchsize entries."
+    size = self.batchsize or 1000
+    profiler = profiling.current()
+    batch = []
+    profiler.begin("parse")
+    for entry in self.csv:
+      batch.append(entry)
+      if len(batch) == size:
+        profiler.end(len(batch))
+        yield batch
+        batch = []
+        profiler.begin("parse")
+    profiler.end(len(batch))
+    if batch:
+      yield batch
+
+  def _new_entries(self, batch):
+    "Return the entries in batch that should be mapped, default is all."
+    return batch
+
+  def _map_entry(self, entry):
     pass
+
+  def _commit(self):
+    session.commit()
     
     
 class CSVDBMapper(Mapper):
@@ -44,135 +219,291 @@ class CSVDBMapper(Mapper):
     This is were all the magic happends. All the entries in the csvfile
     parameter is read and fed to the database.
   """
-  def __init__(self, csvfile):
-    self.csv = CSVFile(csvfile, TimeEntry)
-    self.done = False
+  ENTRY = TimeEntry
 
-  def map(self):
-    if not self.done:
-      ts = time.time()
-      entries = 0
-      for entry in self.csv:
-        log.debug("Updating record (%d) %s" % (entries,entry))
-
-        # 1) Check if the customer exists in DB, else create.
-        q = Customer.query.filter_by(name=entry.customer)
-        customer = q.first()  # If there should be multiple names, we ignore them
-        if customer is None:
-          customer = Customer(name=entry.customer)
-          
-        # 2) Check if the project exists in DB, else create.
-        q = Project.query.filter_by(name=entry.project)
-        q = q.filter(Project.customer.has(name=customer.name))
-        project = q.first()  # If there should be multiple names, we ignore them
-        if project is None:
-          project = Project(name=entry.project)
-
-        # 2.5) Set up relationship between customer and project
-        customer.projects.append(project)
-
-        # 3) Check if the employee exists in DB, else create.
-        employee_str = "%s %s" % (entry.first_name, entry.last_name)
-        q = Employee.query.filter_by(name=employee_str)
-        employee = q.first()
-        if employee is None:
-          employee = Employee(name=employee_str)
-
-        # 3.5) Set up relationsship between employee and project
-        if not employee in project.employees:
-          project.employees.append(employee)
-        if not project in employee.projects:
-          employee.projects.append(project)
-        
-        # 4) Skip check exists since it takes to much time. Just add to DB
-        task = Task(name=entry.task,date=entry.date,hours=entry.hours,billable=entry.billable)
-        task.employee = employee
-        task.project = project
-        entries+=1
- 
-        # 5) Commit and we are ready for a new one!
-        #session.flush()
-        session.commit()
+  def __init__(self, csvfile, entries=None):
+    Mapper.__init__(self, csvfile, entries)
+    self.occurrences = {}
 
-      
-      log.info("It took %d seconds to update %d entries." % (time.time()-ts, entries))
-      done = True
-    else:
-      pass                     
+  def _new_entries(self, batch):
+    """
+      Skip the entries that already have been imported, i.e. their digest
+      is in the DB. Identical rows in a file are told apart by counting
+      them, the n:th occurrence of a row gets the digest of the row and n.
+      Re-importing an overlapping file thus only adds the new rows.
+    """
+    for entry in batch:
+      n = self.occurrences.get(entry.digest, 0)
+      self.occurrences[entry.digest] = n + 1
+      if n > 0:
+        entry.digest = occurrence_digest(entry.digest, n)
+
+    digests = [entry.digest for entry in batch]
+    seen = set()
+    column = Task.table.c.digest
+    for i in range(0, len(digests), 500):  # Stay below SQLite's 999 variables
+      q = select([column], column.in_(digests[i:i+500]))
+      seen.update([row[0] for row in session.execute(q)])
+    return [entry for entry in batch if not entry.digest in seen]
+
+  def _map_entry(self, entry):
+    # 1) Look up the customer, project and employee, they are created if
+    #    they do not exist in the DB.
+    customer = self.cache.customer(entry.customer)
+    project = self.cache.project(customer, entry.project)
+    employee = self.cache.employee("%s %s" % (entry.first_name, entry.last_name))
+
+    # 2) Set up relationsship between employee and project
+    self.cache.add_member(project, employee)
+    
+    # 3) Add the task, _new_entries() has already skipped the existing ones
+    task = Task(name=entry.task,date=entry.date,hours=entry.hours,billable=entry.billable,digest=entry.digest)
+    task.employee = employee
+    task.project = project
+
+  def _commit(self):
+    # The new tasks are added to the rollups in the same transaction
+    session.flush()
+    rollup.update()
+    session.commit()
+
+class BulkCSVDBMapper(CSVDBMapper):
+  """
+    A faster variant of CSVDBMapper. Customers, projects and employees are
+    resolved through the ORM as usual, but the tasks are written with
+    executemany-style inserts directly to the task table, in chunks of
+    CHUNKSIZE rows. The resulting database is the same as with CSVDBMapper.
+  """
+
+  CHUNKSIZE = 5000
+
+  def __init__(self, csvfile, entries=None):
+    CSVDBMapper.__init__(self, csvfile, entries)
+    self.pending = []
+
+  def _map_entry(self, entry):
+    customer = self.cache.customer(entry.customer)
+    project = self.cache.project(customer, entry.project)
+    employee = self.cache.employee("%s %s" % (entry.first_name, entry.last_name))
+    self.cache.add_member(project, employee)
+    self.pending.append((entry, project, employee))
+    if len(self.pending) >= BulkCSVDBMapper.CHUNKSIZE:
+      self._insert_pending()
+
+  def _commit(self):
+    self._insert_pending()
+    CSVDBMapper._commit(self)
+
+  def _insert_pending(self):
+    if not self.pending:
+      return
+    session.flush()  # New projects and employees need their keys
+    rows = []
+    for entry, project, employee in self.pending:
+      rows.append({ 'name': entry.task,
+                    'date': entry.date,
+                    'hours': entry.hours,
+                    'billable': entry.billable,
+                    'digest': entry.digest,
+                    'employee_name': employee.name,
+                    'project_id': project.id })
+    session.execute(Task.table.insert(), rows)
+    self.pending = []
 
 class POMapper(Mapper):
 
-  def __init__(self, csvfile):
-    self.csv = CSVFile(csvfile, POEntry)
-    self.done = False
+  ENTRY = POEntry
   
-  def map(self):
-    if not self.done:
-      ts = time.time()
-      entries = 0
-      for entry in self.csv:
-        log.debug("Updating record (%d) %s" % (entries,entry))
-
-        # 1) Check if the employee exists in DB, else create.
-        employee_str = entry.employee
-        q = Employee.query.filter_by(name=employee_str)
-        employee = q.first()
-        if employee is None:
-          employee = Employee(name=employee_str)
-        
-        # 2) Create Purchase order
-        po = PurchaseOrder(number=entry.number,start=entry.start,stop=entry.stop,price=entry.price,customer=entry.customer,reference=entry.reference)
-        po.employee = employee
-        entries+=1
-        
-        # 3) Set up relationship between employee and PO
-        employee.pos.append(po)
-        
-        session.commit()
-
-      
-      log.info("It took %d seconds to update %d entries." % (time.time()-ts, entries))
-      done = True
-    else:
-      pass
+  def _map_entry(self, entry):
+    # 1) Look up the employee, create it if it does not exist.
+    employee = self.cache.employee(entry.employee)
+    
+    # 2) Create Purchase order
+    po = PurchaseOrder(number=entry.number,start=entry.start,stop=entry.stop,price=entry.price,customer=entry.customer,reference=entry.reference)
+    po.employee = employee
+    
+    # 3) Set up relationship between employee and PO
+    employee.pos.append(po)
     
   
 class CWMapper(Mapper):
   
-  def __init__(self, csvfile):
-    self.csv = CSVFile(csvfile, CWEntry)
-    self.done = False
+  ENTRY = CWEntry
     
-  def map(self):
-    if not self.done:
-      ts = time.time()
-      entries = 0
-      for entry in self.csv:
-        log.debug("Updating record (%d) %s" % (entries,entry))
-
-        # 1) Check if the employee exists in DB, else create.
-        employee_str = entry.employee
-        q = Employee.query.filter_by(name=employee_str)
-        employee = q.first()
-        if employee is None:
-          employee = Employee(name=employee_str)
-        
-        # 2) Update employee number
-        employee.number = entry.number
-        
-        # 3) Check if office exists in DB, else create.
-        q = Office.query.filter_by(name=entry.office)
-        office = q.first()
-        if office is None:
-          office = Office(name=entry.office)
-        
-        office.employees.append(employee)
-        employee.office = office
-
-        entries+=1
-        session.commit()
+  def _map_entry(self, entry):
+    # 1) Look up the employee, create it if it does not exist.
+    employee = self.cache.employee(entry.employee)
+    
+    # 2) Update employee number
+    employee.number = entry.number
+    
+    # 3) Look up the office, create it if it does not exist.
+    office = self.cache.office(entry.office)
+    
+    office.employees.append(employee)
+    employee.office = office
 
-      log.info("It took %d seconds to update %d entries." % (time.time()-ts, entries))
-      done = True
-    else:
-      pass   
\ No newline at end of file
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestBulkCSVDBMapper(unittest.TestCase):
+
+  def setUp(self):
+    self.DATAFILE = "testdata/testdata.csv"
+    self.bind = metadata.bind
+    metadata.bind = "sqlite:///:memory:"
+    create_all()
+
+  def tearDown(self):
+    session.close()
+    drop_all()
+    metadata.bind = self.bind
+
+  def _dump(self):
+    session.clear()
+    tasks = [(t.employee.name, t.project.customer.name, t.project.name, t.name, t.date, t.hours, t.billable) for t in Task.query.all()]
+    members = [(p.customer.name, p.name, e.name) for p in Project.query.all() for e in p.employees]
+    tasks.sort()
+    members.sort()
+    return tasks, members
+
+  def testSameAsORM(self):
+    CSVDBMapper(self.DATAFILE).map()
+    expected = self._dump()
+    session.clear()
+    drop_all()
+    create_all()
+    BulkCSVDBMapper(self.DATAFILE).map()
+    self.assertEquals(expected, self._dump())
+    self.assertNotEquals(0, len(expected[0]), "There should be tasks in the file")
+
+  def testReimport(self):
+    CSVDBMapper(self.DATAFILE).map()
+    tasks = Task.query.count()
+    CSVDBMapper(self.DATAFILE).map()
+    BulkCSVDBMapper(self.DATAFILE).map()
+    self.assertEquals(tasks, Task.query.count(), "Re-imported rows should be skipped")
+
+  def testMigrate(self):
+    CSVDBMapper(self.DATAFILE).map()
+    expected = [(t.id, t.digest) for t in Task.query.order_by(Task.id)]
+    session.clear()
+    # The task table as it was before the digests
+    for name, in metadata.bind.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '%digest%'"):
+      metadata.bind.execute("DROP INDEX %s" % name)
+    metadata.bind.execute("ALTER TABLE %s DROP COLUMN digest" % Task.table.name)
+    migrate()
+    self.assertEquals(expected, [(t.id, t.digest) for t in Task.query.order_by(Task.id)])
+    CSVDBMapper(self.DATAFILE).map()
+    BulkCSVDBMapper(self.DATAFILE).map()
+    self.assertEquals(len(expected), Task.query.count(), "Migrated rows should be skipped")
+
+
+class TestSyntheticData(unittest.TestCase):
+  "The generated files of benchmark.py are read just like the real ones."
+
+  def setUp(self):
+    import tempfile
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  def testWriteCSVs(self):
+    from benchmark import write_csvs
+    paths, count = write_csvs(self.directory, years=1, employees=3, projects=2)
+    self.assertEquals(["coworkers.csv", "purchase-orders.csv", "harvest.csv"], [os.path.basename(path) for path in paths])
+    bind = metadata.bind
+    metadata.bind = "sqlite:///:memory:"
+    create_all()
+    try:
+      for cls, path in zip((CWMapper, POMapper, CSVDBMapper), paths):
+        cls(path).map()
+      self.assertEquals(count, Task.query.count())
+      self.assertEquals(3, Employee.query.filter(Employee.number != None).count())
+      self.assertEquals(3, PurchaseOrder.query.count())
+      self.assertTrue(Task.query.filter(Task.billable == False).count() > 0, "Some tasks should be internal")
+    finally:
+      session.close()
+      drop_all()
+      metadata.bind = bind
+
+  def testParallelImport(self):
+    from benchmark import write_csvs
+    from update_db import _get_mapper, _map_parallel
+    paths, count = write_csvs(self.directory, years=1, employees=3, projects=2)
+    bind = metadata.bind
+    try:
+      dumps = []
+      for bulk in (False, True):
+        for jobs in (1, 2):
+          metadata.bind = "sqlite:///:memory:"
+          create_all()
+          if jobs == 1:
+            for path in paths:
+              _get_mapper(path, bulk).map()
+          else:
+            _map_parallel(paths, jobs, bulk)
+          dumps.append([(name, sorted([tuple(row) for row in metadata.bind.execute("SELECT * FROM %s" % name)]))
+                        for name in sorted(metadata.tables.keys())])
+          session.close()
+          drop_all()
+        self.assertEquals(dumps[-2], dumps[-1], "--jobs 2 should import the same rows as --jobs 1")
+      self.assertEquals(count, len(dict(dumps[0])[Task.table.name]))
+    finally:
+      session.close()
+      metadata.bind = bind
+
+  def testBenchIndexes(self):
+    from benchmark import synthetic_db, bench_indexes
+    url = "sqlite:///%s" % os.path.join(self.directory, "synthetic.sqlite")
+    bind = metadata.bind
+    engine = synthetic_db(url, years=1, employees=3, projects=2)
+    try:
+      self.assertTrue(engine.execute(Task.table.count()).scalar() > 0)
+      bench_indexes(engine, "2009-05")
+      self.assertTrue(metadata.bind is bind)
+      existing = [row[0] for row in engine.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+      self.assertEquals([], [index_name(entity, columns) for entity, columns in INDEXES if not index_name(entity, columns) in existing])
+      engine.execute(Employee.table.insert(), {'name': u"Anna Svensson"})
+    finally:
+      engine.dispose()
+    self.assertRaises(Exception, synthetic_db, url)
+
+  def testBenchRollups(self):
+    import rollup
+    from benchmark import synthetic_db, bench_rollups, _bound
+    engine = synthetic_db("sqlite:///%s" % os.path.join(self.directory, "synthetic.sqlite"), years=1, employees=3, projects=2)
+    try:
+      bench_rollups(engine, "2009-05")  # Raises if the rollups are not current when timed
+      self.assertTrue(_bound(engine, rollup.is_current), "The rollup state should be restored")
+    finally:
+      engine.dispose()
+
+  def testEndToEnd(self):
+    from cStringIO import StringIO
+    from benchmark import STAGES, bench_end_to_end, write_results
+    results = bench_end_to_end(self.directory, employees=2, years=1, projects=2)
+    self.assertEquals([stage for stage in STAGES if stage != "memory-load"], [result['stage'] for result in results])
+    self.assertTrue(results[1]['statements'] > 0)
+    out = StringIO()
+    write_results(out, results, results[:1])
+    lines = out.getvalue().splitlines()
+    self.assertEquals(len(STAGES), len(lines))
+    self.assertTrue(lines[1].endswith("+0%"))
+    self.assertTrue(lines[2].endswith("-"))
+
+  def testEndToEndInMemory(self):
+    from benchmark import STAGES, bench_end_to_end
+    default = bench_end_to_end(self.directory, employees=2, years=1, projects=2)
+    memory = bench_end_to_end(self.directory, employees=2, years=1, projects=2, mode="memory")
+    self.assertEquals(list(STAGES), [result['stage'] for result in memory])
+    self.assertEquals(["memory"], list(set([result['mode'] for result in memory])))
+    self.assertEquals(default[-1]['statements'], memory[-1]['statements'])
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.ERROR,format='%(asctime)s %(levelname)s %(message)s')
+  unittest.main()
@@ -23,6 +23,9 @@ along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from elixir import *
+from hashlib import md5
+from sqlalchemy import DDL, Index, and_, bindparam, select
+import sys
 import unittest
 
 from csvparser import CSVFile
@@ -75,15 +78,63 @@ class Task(Entity):
   billable = Field(Boolean())
   employee = ManyToOne('Employee')
   project = ManyToOne('Project')
+  digest = Field(Unicode(32), index=True, unique=True)
 
   def __repr__(self):
     return '<Task "%s - %s %0.2f hours at %s">' % (self.date, self.employee.name, self.hours,self.name)
   
+class MonthRollup(Entity):
+  """
+    The hours of an employee on a task of a project summed by month. The
+    rollups are kept up to date by rollup.update() when tasks are imported.
+    first_task is the smallest task id in the group, it keeps the order in
+    which the tasks were added.
+  """
+  year = Field(Integer())
+  month = Field(Integer())
+  name = Field(Unicode(50))
+  hours = Field(Float())
+  first_task = Field(Integer())
+  employee = ManyToOne('Employee')
+  project = ManyToOne('Project')
+
+class WeekRollup(Entity):
+  "The same as MonthRollup but by ISO year and week."
+  year = Field(Integer())
+  week = Field(Integer())
+  name = Field(Unicode(50))
+  hours = Field(Float())
+  first_task = Field(Integer())
+  employee = ManyToOne('Employee')
+  project = ManyToOne('Project')
+
+class RollupState(Entity):
+  """
+    A single row with the id of the last task included in the rollups and
+    the value of ChangeCounter.tasks they were last updated at.
+  """
+  last_task = Field(Integer())
+  tasks = Field(Integer())
+
+class ChangeCounter(Entity):
+  """
+    A single row with the number of imports that have changed the DB. The
+    mappers bump it, and cached reports are only valid for the count they
+    were made at (see reportcache.py). tasks is the number of task rows
+    that have been inserted, updated or deleted, it is counted by the
+    triggers of setup_triggers() so changes made outside the mappers are
+    seen too.
+  """
+  changes = Field(Integer())
+  tasks = Field(Integer())
+
 class POEntry(object):
   """
     A data class that holds information from a Purchase Order CSV file.
     employee,customer,reference,price,start,stop,po-number
   """
+  __slots__ = ('employee', 'customer', 'reference', 'price', 'start', 'stop', 'number')
+
   def __init__(self,employee,customer,reference,price,start,stop,number):
     self.employee = employee
     self.customer = customer
@@ -94,6 +145,12 @@ class POEntry(object):
     self.number = number
 
 class CWEntry(object):
+  """
+    A data class that holds information from a coworker CSV file.
+    employee,employee number,branch office
+  """
+  __slots__ = ('employee', 'number', 'office')
+
   def __init__(self,employee,number,office):
     self.employee = employee
     self.number = number
@@ -121,7 +178,14 @@ class TimeEntry(object):
     # 14)  Cost as float
     # 15)  Department
 
+    The fields are stored in __slots__ instead of a __dict__, which makes
+    each entry 176 bytes instead of 1112 on a 64-bit Python 2.7, not
+    counting the field values (see TestTimeEntry.testMemoryPerRow).
   """
+  __slots__ = ('date', 'customer', 'project', 'project_code', 'task', 'note',
+               'hours', 'first_name', 'last_name', 'billable', 'evsc',
+               'approved', 'rate', 'cost', 'department', 'digest')
+
   def __init__(self,date,customer,project,project_code,task,note,hours,first_name,last_name,billable,evsc,approved,rate,cost,department):
     self.date = date
     self.customer = customer
@@ -132,32 +196,126 @@ class TimeEntry(object):
     self.hours = float(hours)
     self.first_name = first_name
     self.last_name = last_name
-    if billable == "billable":
-      self.billable = True
-    else:
-      self.billable = False
-    if evsc == "employee":
-      self.evsc = True
-    else:
-      self.evsc = False
-    if approved == "yes":
-      self.approved = True
-    else:
-      self.approved = False
+    self.billable = billable == "billable"
+    self.evsc = evsc == "employee"
+    self.approved = approved == "yes"
     self.rate = float(rate)
     self.cost = float(cost)
-    #self.digest = self._calcdigest()
     self.department = department
+    self.digest = self._calcdigest()
   
   def _calcdigest(self):
-    import md5
-    str = "%s%s%s%s%s%s%s%s" % (self.date,self.customer,self.project,self.task,self.hours,self.first_name,self.last_name,self.billable)
-    hexdigest=md5.md5(str.encode('iso-8859-1')).hexdigest()
-    return unicode(hexdigest, 'utf-8')
+    return task_digest(self.date,self.customer,self.project,self.task,self.hours,self.first_name,self.last_name,self.billable)
 
   def __str__(self):
     return "%s - %s %s, %0.2f hours at %s working with %s" % (self.date, self.first_name, self.last_name, self.hours, self.customer, self.task) 
 
+def task_digest(date,customer,project,task,hours,first_name,last_name,billable):
+  "The digest of a Harvest time entry, it tells whether it already has been imported."
+  str = u"%s%s%s%s%s%s%s%s" % (date,customer,project,task,hours,first_name,last_name,billable)
+  hexdigest=md5(str.encode('utf-8')).hexdigest()
+  return unicode(hexdigest, 'utf-8')
+
+def occurrence_digest(digest, n):
+  "The digest of the n:th (n > 0) identical time entry of a file, the first one has digest."
+  return md5("%s:%d" % (digest, n)).hexdigest().decode('ascii')
+
+
+# The indexes for the report queries, (entity, columns). They are declared
+# by setup_indexes() since the tables do not exist until the entities are
+# set up.
+INDEXES = [ (Task, ('date',)),
+            (Task, ('employee_name', 'date')),
+            (PurchaseOrder, ('employee_name', 'start', 'stop')),
+            (MonthRollup, ('year', 'month')),
+            (WeekRollup, ('year', 'week')), ]
+
+def index_name(entity, columns):
+  "The name of the index of INDEXES on columns of entity."
+  return "ix_%s_%s" % (entity.table.name, "_".join(columns))
+
+def setup_indexes():
+  for entity, columns in INDEXES:
+    name = index_name(entity, columns)
+    if not name in [index.name for index in entity.table.indexes]:
+      Index(name, *[entity.table.c[column] for column in columns])
+
+def _task_triggers():
+  """
+    The statements that create the triggers counting the changes of the
+    tasks in ChangeCounter.tasks. Changing only the digest is not counted.
+  """
+  count = ("BEGIN INSERT OR IGNORE INTO %(counter)s (id, changes, tasks) VALUES (1, 0, 0); "
+           "UPDATE %(counter)s SET tasks = coalesce(tasks, 0) + 1; END")
+  events = [("insert", "INSERT"),
+            ("update", "UPDATE OF name, date, hours, billable, employee_name, project_id"),
+            ("delete", "DELETE")]
+  names = {'counter': ChangeCounter.table.name, 'task': Task.table.name}
+  return [("CREATE TRIGGER IF NOT EXISTS %(task)s_" + name + " AFTER " + event + " ON %(task)s " + count) % names
+          for name, event in events]
+
+def setup_triggers():
+  "Create the task triggers together with the task table."
+  for statement in _task_triggers():
+    DDL(statement).execute_at('after-create', Task.table)
+
+def migrate():
+  """
+    Bring a DB created by an older version of the model up to date,
+    setup_all() only creates the tables that are missing.
+  """
+  for table in metadata.tables.values():
+    columns = [row[1] for row in metadata.bind.execute("PRAGMA table_info(%s)" % table.name)]
+    for column in table.columns:
+      if not column.name in columns:
+        spec = column.type.dialect_impl(metadata.bind.dialect).get_col_spec()
+        metadata.bind.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name, column.name, spec))
+
+  existing = [row[0] for row in metadata.bind.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+  for table in metadata.tables.values():
+    for index in table.indexes:
+      if not index.name in existing:
+        index.create()
+
+  for statement in _task_triggers():
+    metadata.bind.execute(statement)
+
+  if metadata.bind.execute(select([Task.table.c.id], Task.table.c.digest == None, limit=1)).fetchone() is not None:
+    backfill_digests()
+
+def backfill_digests():
+  """
+    Give the tasks that were imported before the digests existed the
+    digest of the time entry they were made from, so that importing the
+    same file again skips them. The employee name is split into first and
+    last name at the first space, the way CSVDBMapper joined them. Identical
+    tasks get the digest of their occurrence in id order, just like
+    identical rows of a file. Returns the number of tasks updated.
+  """
+  t, p, c = Task.table, Project.table, Customer.table
+  taken = set([row[0] for row in session.execute(select([t.c.digest], t.c.digest != None))])
+  occurrences = {}
+  rows = []
+  q = select([t.c.id, t.c.date, c.c.name, p.c.name, t.c.name, t.c.hours, t.c.employee_name, t.c.billable],
+             and_(t.c.digest == None, t.c.project_id == p.c.id, p.c.customer_id == c.c.id), order_by=[t.c.id])
+  for id, date, customer, project, name, hours, employee, billable in session.execute(q):
+    first_name, last_name = (employee.split(" ", 1) + [u""])[:2]
+    digest = task_digest(date, customer, project, name, hours, first_name, last_name, bool(billable))
+    n = occurrences.get(digest, 0)
+    candidate = digest
+    if n > 0:
+      candidate = occurrence_digest(digest, n)
+    while candidate in taken:  # Already given to a task imported after the column was added
+      n+=1
+      candidate = occurrence_digest(digest, n)
+    occurrences[digest] = n + 1
+    taken.add(candidate)
+    rows.append({'task_id': id, 'digest': candidate})
+  if rows:
+    session.execute(t.update(t.c.id == bindparam('task_id')), rows)
+  session.commit()
+  return len(rows)
+
 
 # Unit tests below
 #----------------------------------------------------------------------------
@@ -172,11 +330,27 @@ class TestTimeEntry(unittest.TestCase):
     for entry in csv:
       self.assertEquals(0.0, entry.cost * entry.rate, "The cost and rate is always 0.0")
       self.assertEquals("200", entry.date[:3], "The first three chars should be 200")
+
+  def testMemoryPerRow(self):
+    entry = CSVFile(self.DATAFILE, TimeEntry).next()
+    self.assertFalse(hasattr(entry, '__dict__'), "Entries should not have a __dict__")
+    class DictEntry(object):
+      pass
+    plain = DictEntry()
+    for name in TimeEntry.__slots__:
+      setattr(plain, name, getattr(entry, name))
+    size = sys.getsizeof(entry)
+    plain_size = sys.getsizeof(plain) + sys.getsizeof(plain.__dict__)
+    self.assertTrue(size * 4 < plain_size, "A TimeEntry (%d bytes) should be a fraction of the same object with a __dict__ (%d bytes)" % (size, plain_size))
     
 
 if __name__ == "__main__":
   unittest.main()
 else:
   from config import cfg
-  metadata.bind = cfg['db.bind']
-  setup_all(True)
+  import storage
+  setup_all()
+  setup_indexes()
+  setup_triggers()
+  storage.bind(metadata, cfg['db.bind'], cfg.get('db.mode', 'default'), cfg)
+  migrate()
@@ -24,220 +24,559 @@ along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
 import datetime
-from time import strptime, strftime    
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from cStringIO import StringIO
+from itertools import izip
+from optparse import OptionParser
 
 from model import *
+import calendars
 from config import cfg
+import profiling
+import reportcache
+import reporting
+import rollup
 from statistics_month import DateModel
 
-# Code from
-# http://code.activestate.com/recipes/521915/
-# Recipe 521915: start date and end date of given week      
-# Snippet start
-def _getWeekDetails(_weekNo, _Year, _weekStart): 
-  _weekNo = _weekNo - 1  # Quickfix for 2009
-  rslt = []
-  janOne = strptime('%s-01-01' % _Year, '%Y-%m-%d')
-  dayOfFirstWeek = ((7-int((strftime("%u",janOne)))+ int(_weekStart)) % 7)
-  if dayOfFirstWeek == 0:
-    dayOfFirstWeek = 7
-  dateOfFirstWeek = strptime('%s-01-%s' % (_Year, dayOfFirstWeek), '%Y-%m-%d')
-  dayOne = datetime.datetime( dateOfFirstWeek.tm_year, dateOfFirstWeek.tm_mon, dateOfFirstWeek.tm_mday )
-  daysToGo = 7*(int(_weekNo)-1)
-  lastDay = daysToGo+6
-  dayX = dayOne + datetime.timedelta(days = daysToGo)
-  dayY = dayOne + datetime.timedelta(days = lastDay)
-  resultDateX = strptime('%s-%s-%s' % (dayX.year, dayX.month, dayX.day), '%Y-%m-%d')
-  resultDateY = strptime('%s-%s-%s' % (dayY.year, dayY.month, dayY.day), '%Y-%m-%d')
-  rslt.append(resultDateX)
-  rslt.append(resultDateY)
-  return rslt   
-# Snippet end
+# The tasks of this project are listed one by one in the salary section
+INTERNAL = u"Internal"
                        
 class MonthlyReport(object):
-  def __init__(self, period):
+  def __init__(self, period, jobs=1):
+    self.name = period
+    self.jobs = jobs
     self.month = "%s-01" % period
     self.date = DateModel(self.month)
     self.start = self.date.get_month_start()
     self.stop = self.date.get_month_stop()
-    self.period = cfg['purple_heart'][int(period.split("-")[1])]
-          
+    self.first = datetime.date(self.date.year, self.date.month, 1)
+    self.last = datetime.date(self.date.year, self.date.month, self.date.days)
+    # The days and weeks of the month come from the working-day calendar
+    # unless the config has the old hand-typed tables
+    work = calendars.get_calendar()
+    if cfg.has_key('daysofmonth'):
+      self.workdays = cfg['daysofmonth'][self.date.month]
+    else:
+      self.workdays = work.working_days(self.date.year, self.date.month)
+    if cfg.has_key('purple_heart'):
+      self.period = cfg['purple_heart'][self.date.month]
+    else:
+      self.period = work.month_weeks(self.date.year, self.date.month)
+    self.weeks = [(week,) + calendars.week_window(self.date.year, week) for week in self.period]
+    self.rows = None
+    self.pos = None
+    self.cache = None
+    self.totals = None
+
+  def span(self):
+    "Return the first and last date of the tasks the report is made from."
+    return min([self.first] + [w[1] for w in self.weeks]), max([self.last] + [w[2] for w in self.weeks])
+
   def get_report(self):
-    "Return a string ready to be printed." 
-    
+    "Return a string ready to be printed, see write."
+    out = StringIO()
+    self.write(out)
+    return out.getvalue()
+
+  def write(self, out):
+    """
+      Write the report to out like write_report. When cache is set to a
+      reportcache.ReportCache the report, and its totals, are taken from it
+      if the DB has not changed since it was made, the text is copied to
+      out in blocks. Otherwise the report is written to out and to the
+      cache at the same time.
+    """
+    if self.cache is None:
+      self.write_report(out)
+      return
+    key = self.cache.key("monthly-report", self.name)
+    result = self.cached(key)
+    if result is not None and result[0]:
+      text = self.cache.open_text(key)
+      if text is not None:
+        try:
+          shutil.copyfileobj(text, out)
+        finally:
+          text.close()
+        self.totals = result[1]
+        return
+    self.cache.put_text(key, lambda spool: self.write_report(_Tee(out, spool)))
+    time, billable, offices = self.totals
+    self.cache.put(key, (True, (time, billable, _ordered(offices))))
+
+  def cached(self, key=None):
+    """
+      Return whether the report text is in cache and the totals, None if
+      they are not in it. A month without tasks is kept as (False, None).
+    """
+    if self.cache is None:
+      return None
+    if key is None:
+      key = self.cache.key("monthly-report", self.name)
+    profiling.current().begin("cache")
+    result = self.cache.get(key)
+    profiling.current().end(int(result is not None))
+    return result
+
+  def write_report(self, out):
+    """
+      Write the report to out, any file-like object. The employee sections
+      are written to a temporary file as soon as they are done, since the
+      statistics in front of them depend on all employees. They are copied
+      to out after the statistics, so only one section at a time is kept
+      in memory. When rows is set to the TaskRows of span(), in id order,
+      the report is made from them instead of querying the DB for tasks
+      (see _load()). The purchase orders are looked up in pos, a
+      reporting.POIndex that is loaded if it is not set, and can be shared
+      by the reports of a range. The company and office totals are kept in
+      totals afterwards.
+    """
     total_time = 0
     total_billable = 0
     office_time = {}
     not_active = []  # Employees with no time entries at all
     incomplete = []  # Employees with some entries, but not enough
     
-    result_header = "Billing report for %s to %s (%d days total)\n\n" % (self.start, self.stop, cfg['daysofmonth'][self.date.get_month_number()])  
+    result_header = "Billing report for %s to %s (%d days total)\n\n" % (self.start, self.stop, self.workdays)  
     result_stats = ""
-    result_rpt = ""
+
+    profiler = profiling.current()
+    profiler.begin("load")
+    weeks = self.weeks
+    serial = self.jobs <= 1  # Or the workers load the rest
+    if self.pos is None and serial:
+      self.pos = reporting.POIndex()
+    month_entries, week_tasks = self._load(week_tasks=serial)
+    offices = Office.query.all()  # Keeps employee.office from querying
 
     # x.name.encode('utf-8')
     employees = Employee.query.order_by(Employee.number)
 
+    active = []
     for employee in employees:
-      entries = self._get_employee_entries(employee.name.encode("utf-8"))
-      
-      if len(entries.keys()) > 0:
-        total = 0
-        avail = 0
-        billable = 0
-        eno = -1
-        if employee.number is not None:
-          eno = employee.number
-        result_rpt += ":: %s (%d) ::\n\n- Reported time\n" % (employee.name.encode("utf-8"), eno)
-        for customer in entries.keys():
-          for project in entries[customer].keys():
-            for task in entries[customer][project].keys():
-              result_rpt += "\t* %s / %s / %s:%0.2f\n" % (customer, project, task, entries[customer][project][task])
-              if task in cfg["billable"]:
-                billable += entries[customer][project][task]
-              
-              if task in cfg["absence"]:
-                avail -=  entries[customer][project][task]
-                
-              total += entries[customer][project][task]
-        result_rpt += "\t* Total time reported: %0.2f\n" % total
-        
-        
-        available = cfg['daysofmonth'][self.date.get_month_number()] * 8
-        if cfg['parttime'].has_key(employee.name.encode("utf-8")):
-          available = available * cfg['parttime'][employee.name.encode("utf-8")]
-        
-        total_time += available + avail
+      if len(month_entries.get(employee.name, {}).keys()) > 0:
+        active.append(employee)
+      else:
+        not_active.append(employee.name.encode("utf-8"))
+    profiler.end(_count_entries(month_entries))
+
+    spool = tempfile.TemporaryFile()
+    try:
+      profiler.begin("sections")
+      sections = self._sections(active, month_entries, week_tasks, weeks)
+      for employee, (section, office, available, billable, missing) in izip(active, sections):
+        spool.write(section)
+
+        total_time += available
         total_billable += billable
-        
-        office = "No office"
-        if employee.office is not None:
-          office = employee.office.name.encode('utf-8')
         if not office_time.has_key(office):
           office_time[office] = { "total": 0, "billable": 0 }
-        
-        office_time[office]["total"] += available + avail
+        office_time[office]["total"] += available
         office_time[office]["billable"] += billable
-        
-          
-        if total < available:
-          incomplete.append((employee, (available-total)))
+        if missing > 0:
+          incomplete.append((employee, missing))
+      profiler.end(len(active))
+      
+      profiler.begin("write")
+      result_stats = "- Billing ratio\n\t- Company total\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" %  (total_time, total_billable, ((total_billable/total_time)*100))
+      
+      for office in office_time.keys():
+        result_stats += "\t- %s\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (office, office_time[office]["total"], office_time[office]["billable"], ((office_time[office]["billable"]/office_time[office]["total"])*100))
+      
+      if len(incomplete) > 0:
+        result_stats += "\n\n- Incomplete reports\n"
+      for emp, hours in incomplete:
+        result_stats += "\t* %s is missing %0.2f hours\n" % (emp.name.encode('utf-8'), hours)
+      
+      result_stats += "\n\n"
+      
+      self.totals = (total_time, total_billable, office_time)
+      out.write(result_header)
+      out.write(result_stats)
+      spool.seek(0)
+      shutil.copyfileobj(spool, out)
+      profiler.end()
+    finally:
+      spool.close()
+
+  def _load(self, employees=None, week_tasks=True):
+    """
+      Return the entries of the month (see reporting.month_entries) and,
+      unless week_tasks is False, the tasks of the weeks (see _week_tasks)
+      of the employees in a list of names, or of all employees. They are
+      made from rows if it is set, otherwise they are read from the
+      rollups if they are current, or from the tasks.
+    """
+    weeks = self.weeks
+    tasks = None
+    if self.rows is not None:
+      rows = self.rows
+      if employees is not None:
+        names = set(employees)
+        rows = [row for row in rows if row.employee in names]
+      month_entries = reporting.sum_entries([row for row in rows if self.first <= row.date <= self.last])
+      if week_tasks:
+        tasks = self._week_tasks(weeks, rows=rows)
+    elif rollup.is_current():
+      month_entries = rollup.month_entries(self.date.year, self.date.month, employees)
+      if week_tasks:
+        tasks = self._rollup_week_tasks(weeks, employees)
+    else:
+      month_entries = reporting.month_entries(self.start, self.stop, employees)
+      if week_tasks:
+        tasks = self._week_tasks(weeks, employees=employees)
+    return month_entries, tasks
+
+  def _sections(self, employees, month_entries, week_tasks, weeks):
+    """
+      Yield the sections of the employees (see _employee_section) in order.
+      With more than one job they are made by a pool of processes, each
+      chunk of employees is sent as their names and a worker loads their
+      entries, tasks and purchase orders with its own read-only connection
+      to the DB (rows is not used by the workers). Only the sections are
+      sent back.
+    """
+    if self.jobs <= 1:
+      for employee in employees:
+        yield self._employee_section(employee, month_entries[employee.name], week_tasks.get(employee.name, {}), weeks,
+                                     self.pos.overlapping(employee.name, self.first, self.last))
+      return
+
+    from multiprocessing import Pool
+    pool = Pool(self.jobs, _init_worker)
+    try:
+      size = max(len(employees) / (self.jobs * 4), 1)
+      jobs = [(self.name, [e.name for e in employees[i:i+size]]) for i in range(0, len(employees), size)]
+      for sections in pool.imap(_render_chunk, jobs):
+        for section in sections:
+          yield section
+    finally:
+      pool.close()
+      pool.join()
+
+  def _employee_section(self, employee, entries, tasks, weeks, pos):
+    """
+      Return the report section of an employee with time entries, the
+      entries of the month (see reporting.month_entries), the tasks of the
+      weeks (see _week_tasks) and the purchase orders of the month,
+      together with the employee's part of the statistics: (section,
+      office, available hours, billable hours, missing hours).
+    """
+    result_rpt = ""
+    total = 0
+    avail = 0
+    billable = 0
+    eno = -1
+    if employee.number is not None:
+      eno = employee.number
+    result_rpt += ":: %s (%d) ::\n\n- Reported time\n" % (employee.name.encode("utf-8"), eno)
+    for customer in entries.keys():
+      for project in entries[customer].keys():
+        for task in entries[customer][project].keys():
+          result_rpt += "\t* %s / %s / %s:%0.2f\n" % (customer, project, task, entries[customer][project][task])
+          if task in cfg["billable"]:
+            billable += entries[customer][project][task]
           
-        pos = PurchaseOrder.query.filter(PurchaseOrder.start <= self.stop)
-        pos = pos.filter(PurchaseOrder.stop >= self.start)
-        pos = pos.filter(PurchaseOrder.employee == employee)
+          if task in cfg["absence"]:
+            avail -=  entries[customer][project][task]
+            
+          total += entries[customer][project][task]
+    result_rpt += "\t* Total time reported: %0.2f\n" % total
+    
+    
+    available = self.workdays * 8
+    if cfg['parttime'].has_key(employee.name.encode("utf-8")):
+      available = available * cfg['parttime'][employee.name.encode("utf-8")]
+    
+    office = "No office"
+    if employee.office is not None:
+      office = employee.office.name.encode('utf-8')
+      
+    result_rpt += "\n- Purchase orders\n"
+    if len(pos) > 0:
+      
+      for po in pos:
+         result_rpt += "\t- %s (%s)\n" % (po.customer.encode("utf-8"), po.reference.encode("utf-8"))  
+         result_rpt += "\t\t* PO-number: %s\n" % str(po.number).encode("utf-8")
+         result_rpt += "\t\t* Period: %s to %s\n" % (po.start, po.stop) 
+         result_rpt += "\t\t* Price: %0.2f SEK/hour\n" % (po.price) 
+    else:
+       result_rpt +=  "\t * NO PURCHASE ORDERS FOUND!\n"
+    
+    result_rpt += "\n- Billing ratio\n"
+    result_rpt += "\t* Billable hours: %0.2f\n" % billable
+    result_rpt += "\t* Available hours: %0.2f\n" % (available + avail)
+    result_rpt += "\t* Ratio: %d percent\n" % ((billable/(available+avail))*100)
+    
+    result_rpt += "\n- Salary information\n"
+    purple_hearts = 0
+    overtime = 0
+    for week, weekstart, weekstop in weeks:
+      result_rpt += "\t - Week %d from %s to %s\n" % (week, weekstart, weekstop)
+      
+      week_total = 0
+      week_billable = 0
+      for task in tasks.get(week, []):
+        if not task.name == "Kompledighet":
+          week_total += task.hours
         
-        result_rpt += "\n- Purchase orders\n"
-        if pos.first() is not None:
-          
-          for po in pos:
-             result_rpt += "\t- %s (%s)\n" % (po.customer.encode("utf-8"), po.reference.encode("utf-8"))  
-             result_rpt += "\t\t* PO-number: %s\n" % str(po.number).encode("utf-8")
-             result_rpt += "\t\t* Period: %s to %s\n" % (po.start, po.stop) 
-             result_rpt += "\t\t* Price: %0.2f SEK/hour\n" % (po.price) 
-        else:
-           result_rpt +=  "\t * NO PURCHASE ORDERS FOUND!\n"
+        if task.name.encode("utf-8") in cfg["billable"]:
+           week_billable += task.hours            
         
-        result_rpt += "\n- Billing ratio\n"
-        result_rpt += "\t* Billable hours: %0.2f\n" % billable
-        result_rpt += "\t* Available hours: %0.2f\n" % (available + avail)
-        result_rpt += "\t* Ratio: %d percent\n" % ((billable/(available+avail))*100)
+        if task.project == INTERNAL and task.name != "Kompetensutveckling":
+          result_rpt += "\t\t * %s %s - %0.2f hours\n" % (task.name.encode("utf-8"), task.date, task.hours)
         
-        result_rpt += "\n- Salary information\n"
-        purple_hearts = 0
-        overtime = 0
-        for week in self.period:
-          winfo = _getWeekDetails(week, 2009, 2)
-          weekstart = strftime("%Y-%m-%d", winfo[0])                     
-          weekstop = strftime("%Y-%m-%d", winfo[1])
-          result_rpt += "\t - Week %d from %s to %s\n" % (week, weekstart, weekstop)
-          
-          tasks = Task.query.filter(Task.date >= weekstart) 
-          tasks = tasks.filter(Task.date <= weekstop)
-          tasks = tasks.filter(Task.employee == employee)
-          
-          week_total = 0
-          week_billable = 0
-          for task in tasks:
-            if not task.name == "Kompledighet":
-              week_total += task.hours
-            
-            if task.name.encode("utf-8") in cfg["billable"]:
-               week_billable += task.hours            
-            
-            if task.project.name == "Internal" and task.name != "Kompetensutveckling":
-              result_rpt += "\t\t * %s %s - %0.2f hours\n" % (task.name.encode("utf-8"), task.date, task.hours)
-            
-            if task.name == "Komptid" or task.name == "Uttag av komp":
-              week_total = week_total - task.hours
-          
-          normal_time = cfg['normal_time']
-          if cfg['parttime'].has_key(employee.name.encode("utf-8")):
-            normal_time = normal_time * cfg['parttime'][employee.name.encode("utf-8")]
-          
-          otime = week_total - normal_time
-          result_rpt += "\t\t * Övertid: %0.2f hours\n" %  otime
-          overtime += otime   
-            
-          result_rpt += "\t\t * Purple Heart time - %0.2f hours\n" % (week_billable)
-            
-          if week_billable >= cfg["normal_time"]:
-            purple_hearts += 1
-          
-          result_rpt +=  "\t\t * Weekly total: %0.2f hours\n\n" % (week_total)
+        if task.name == "Komptid" or task.name == "Uttag av komp":
+          week_total = week_total - task.hours
+      
+      normal_time = cfg['normal_time']
+      if cfg['parttime'].has_key(employee.name.encode("utf-8")):
+        normal_time = normal_time * cfg['parttime'][employee.name.encode("utf-8")]
+      
+      otime = week_total - normal_time
+      result_rpt += "\t\t * Övertid: %0.2f hours\n" %  otime
+      overtime += otime   
         
-        result_rpt += "\t - Övertidsdelta: %0.2f hours\n\n" % (overtime)
-        extra = 1
-        if purple_hearts == len(self.period):
-          extra = 2
-        result_rpt += "\t - Purple Hearts: %d of %d = %d kr\n" % (purple_hearts, len(self.period), (purple_hearts*350) * extra )   
+      result_rpt += "\t\t * Purple Heart time - %0.2f hours\n" % (week_billable)
         
-        result_rpt += "\n\n\n"
-      else:
-        not_active.append(employee.name.encode("utf-8"))
+      if week_billable >= cfg["normal_time"]:
+        purple_hearts += 1
       
-    result_stats = "- Billing ratio\n\t- Company total\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" %  (total_time, total_billable, ((total_billable/total_time)*100))
-    
-    for office in office_time.keys():
-      result_stats += "\t- %s\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (office, office_time[office]["total"], office_time[office]["billable"], ((office_time[office]["billable"]/office_time[office]["total"])*100))
+      result_rpt +=  "\t\t * Weekly total: %0.2f hours\n\n" % (week_total)
     
-    if len(incomplete) > 0:
-      result_stats += "\n\n- Incomplete reports\n"
-    for emp, hours in incomplete:
-      result_stats += "\t* %s is missing %0.2f hours\n" % (emp.name.encode('utf-8'), hours)
+    result_rpt += "\t - Övertidsdelta: %0.2f hours\n\n" % (overtime)
+    extra = 1
+    if purple_hearts == len(self.period):
+      extra = 2
+    result_rpt += "\t - Purple Hearts: %d of %d = %d kr\n" % (purple_hearts, len(self.period), (purple_hearts*350) * extra )   
     
-    result_stats += "\n\n"
-    
-    return result_header + result_stats + result_rpt
-
-  def _get_employee_entries(self,employee):
-    tasks = Task.query.filter(Task.date >= self.start)
-    tasks = tasks.filter(Task.date <= self.stop)
-    tasks = tasks.filter(Task.employee.has(name=unicode(employee,"utf-8")))
-    return self._aggregate_by_customer(tasks)
+    result_rpt += "\n\n\n"
+    return result_rpt, office, available + avail, billable, available - total
 
-  def _aggregate_by_customer(self, tasks):
+  def _week_tasks(self, weeks, project=None, rows=None, employees=None):
+    """
+      Return the task rows of the weeks, (week, start, stop) tuples, as
+      {employee: {week: [rows]}}, optionally only for one project and the
+      employees in a list of names. The rows are queried unless they are
+      given.
+    """
+    if rows is None:
+      rows = reporting.task_rows(min([w[1] for w in weeks]), max([w[2] for w in weeks]), project=project, employees=employees)
     result = {}
-    for task in tasks:
-      customer =  task.project.customer.name.encode("utf-8")
-      project =  task.project.name.encode("utf-8")
-      task_name = task.name.encode("utf-8")
+    for row in rows:
+      for week, weekstart, weekstop in weeks:
+        if weekstart <= row.date <= weekstop:
+          result.setdefault(row.employee, {}).setdefault(week, []).append(row)
+    return result
 
-      if not result.has_key(customer):
-        result[customer] = {}
+  def _rollup_week_tasks(self, weeks, employees=None):
+    """
+      The same as _week_tasks() but with the hours summed by project and
+      task from the week rollups. The INTERNAL tasks are listed one by one,
+      they are still read from the tasks.
+    """
+    isoweeks = {}
+    for week, weekstart, weekstop in weeks:
+      if weekstart.weekday() != 0 or (weekstop - weekstart).days != 6:
+        return self._week_tasks(weeks, employees=employees)  # Not an ISO week
+      isoweeks[weekstart.isocalendar()[:2]] = week
 
-      if not result[customer].has_key(project):
-        result[customer][project] = {}
+    result = self._week_tasks(weeks, INTERNAL, employees=employees)
+    for year, week, row in rollup.week_rows(isoweeks.keys(), employees):
+      if row.project != INTERNAL:
+        result.setdefault(row.employee, {}).setdefault(isoweeks[(year, week)], []).append(row)
+    return result
 
-      if not result[customer][project].has_key(task_name):
-        result[customer][project][task_name] = 0
+class RangeReport(object):
+  """
+    The monthly reports of the months first to last (YYYY-MM) made from one
+    scan of the tasks, and a summary of the billing ratios of the range.
+  """
 
-      result[customer][project][task_name] += task.hours
-    return result
+  def __init__(self, first, last, jobs=1, cache=None):
+    self.first = first
+    self.last = last
+    self.reports = [MonthlyReport(period, jobs) for period in _months(first, last)]
+    for report in self.reports:
+      report.cache = cache
+
+  def write_reports(self, directory="."):
+    """
+      Write the report of each month to YYYY-MM.txt and the summary to
+      FIRST..LAST.txt in directory, return the paths. Months without any
+      tasks are skipped. The tasks are only read for the months that are
+      not in the report cache, where the skipped months are kept as None.
+    """
+    cached = dict([(report, report.cached()) for report in self.reports])
+    spans = dict([(report, report.span()) for report in self.reports if cached[report] is None])
+    days = {}
+    if spans:
+      profiling.current().begin("scan")
+      rows = reporting.task_rows(min([s[0] for s in spans.values()]), max([s[1] for s in spans.values()]))
+      for row in rows:
+        days.setdefault(row.date, []).append(row)
+      profiling.current().end(len(rows))
+
+    pos = reporting.POIndex()
+    paths = []
+    done = []
+    for report in self.reports:
+      if cached[report] is not None:
+        written, report.totals = cached[report]
+        if written:
+          paths.append(self._write(directory, "%s.txt" % report.name, report.write))
+          done.append(report)
+        continue
+      first, last = spans[report]
+      rows = []
+      day = first
+      while day <= last:
+        rows.extend(days.get(day, []))
+        day += datetime.timedelta(days=1)
+      if not [row for row in rows if (row.date.year, row.date.month) == (report.date.year, report.date.month)]:
+        if report.cache is not None:
+          report.cache.put(report.cache.key("monthly-report", report.name), (False, None))
+        continue
+      rows.sort(key=lambda row: row.id)
+      report.rows = rows
+      report.pos = pos
+      paths.append(self._write(directory, "%s.txt" % report.name, report.write))
+      report.rows = None
+      report.pos = None
+      done.append(report)
+
+    paths.append(self._write(directory, "%s..%s.txt" % (self.first, self.last), lambda out: self.write_summary(out, done)))
+    return paths
+
+  def write_summary(self, out, reports):
+    "Write the billing ratios of reports, that have been written, and their total to out."
+    total_time = 0
+    total_billable = 0
+    office_time = {}
+    out.write("Billing summary for %s to %s\n\n- Billing ratio by month\n" % (self.first, self.last))
+    for report in reports:
+      time, billable, offices = report.totals
+      out.write("\t- %s\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (report.name, time, billable, ((billable/time)*100)))
+      total_time += time
+      total_billable += billable
+      for office in offices.keys():
+        if not office_time.has_key(office):
+          office_time[office] = { "total": 0, "billable": 0 }
+        office_time[office]["total"] += offices[office]["total"]
+        office_time[office]["billable"] += offices[office]["billable"]
+
+    if total_time > 0:
+      out.write("\n- Billing ratio to date\n\t- Company total\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (total_time, total_billable, ((total_billable/total_time)*100)))
+    for office in office_time.keys():
+      out.write("\t- %s\n\t\t* Available time: %0.2f\n\t\t* Billable time: %0.2f\n\t\t* Ratio: %d percent\n" % (office, office_time[office]["total"], office_time[office]["billable"], ((office_time[office]["billable"]/office_time[office]["total"])*100)))
+
+  def _write(self, directory, name, write):
+    path = os.path.join(directory, name)
+    out = file(path, "w")
+    try:
+      write(out)
+      out.write("\n")
+    finally:
+      out.close()
+    return path
+
+def _months(first, last):
+  "Return the months from first to last, inclusive, as YYYY-MM."
+  year, month = [int(x) for x in first.split("-")]
+  stop = tuple([int(x) for x in last.split("-")])
+  result = []
+  while (year, month) <= stop:
+    result.append("%d-%02d" % (year, month))
+    month += 1
+    if month == 13:
+      month = 1
+      year += 1
+  return result
+
+def _count_entries(month_entries):
+  "The number of (employee, customer, project, task) sums in month_entries."
+  count = 0
+  for customers in month_entries.values():
+    for projects in customers.values():
+      count += sum([len(tasks) for tasks in projects.values()])
+  return count
+
+def _ordered(entries):
+  """
+    Copy the nested entry dicts to OrderedDicts, a dict sent to another
+    process may list its keys in another order, which would change the report.
+  """
+  if not isinstance(entries, dict):
+    return entries
+  return OrderedDict([(key, _ordered(entries[key])) for key in entries.keys()])
+
+class _Tee(object):
+  "A file-like object that writes to two files."
+
+  def __init__(self, first, second):
+    self.first = first
+    self.second = second
+
+  def write(self, data):
+    self.first.write(data)
+    self.second.write(data)
+
+def _init_worker():
+  "Give a report worker process its own read-only connections to the DB."
+  session.remove()
+  metadata.bind = reporting.read_only_engine(metadata.bind)
+
+def _render_chunk(job):
+  """
+    Load and render the sections of a chunk of employees, a list of names,
+    in a worker process, see MonthlyReport._sections().
+  """
+  period, names = job
+  report = MonthlyReport(period)
+  offices = Office.query.all()  # Keeps employee.office from querying
+  employees = dict([(e.name, e) for e in Employee.query.filter(Employee.name.in_(names)).all()])
+  month_entries, week_tasks = report._load(names)
+  pos = reporting.POIndex(names)
+  return [report._employee_section(employees[name], month_entries[name], week_tasks.get(name, {}), report.weeks,
+                                   pos.overlapping(name, report.first, report.last)) for name in names]
 
 if __name__ == "__main__":
-  if len(sys.argv) == 1:
-    print "Usage: python monthly-report.py YYYY-MM"
+  parser = OptionParser(usage="monthly-report.py [options] YYYY-MM | YYYY-MM..YYYY-MM")
+  parser.add_option("-j", "--jobs", type="int", default=1,
+                    help="number of processes that load and render the employee sections")
+  parser.add_option("-d", "--directory", default=".",
+                    help="where to write the reports of a range of months")
+  parser.add_option("--snapshot", action="store_true", default=False,
+                    help="read the tasks from the columnar snapshot (see update_db.py)")
+  parser.add_option("--no-cache", dest="cache", action="store_false", default=True,
+                    help="neither read nor write the report cache, make the report from the DB")
+  profiling.add_options(parser)
+  (options, args) = parser.parse_args()
+  profiling.start_from_options(options, metadata.bind)
+  if len(args) == 0:
+    parser.print_usage()
+  elif ".." in args[0]:
+    first, last = args[0].split("..")
+    cache = None
+    if options.cache:
+      cache = reportcache.ReportCache()
+    for path in RangeReport(first, last, options.jobs, cache).write_reports(options.directory):
+      print "Wrote %s" % path
   else:
-    report = MonthlyReport(sys.argv[1])
-    print report.get_report()
+    report = MonthlyReport(args[0], options.jobs)
+    if options.cache:
+      report.cache = reportcache.ReportCache()
+    if options.snapshot and report.cached() is None:
+      import columnar
+      path = columnar.snapshot_path()
+      if columnar.is_current(path):
+        first, last = report.span()
+        report.rows = columnar.task_rows(columnar.read_snapshot(path, first, last))
+      else:
+        print >> sys.stderr, "The snapshot %s is not up to date, reading the DB instead" % path
+    report.write(sys.stdout)
+    print
+  profiling.stop_from_options(options)
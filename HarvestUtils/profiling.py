@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+profiling.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import resource
+import sys
+import time
+import unittest
+
+class Phase(object):
+  "The totals of all runs of a phase with the same name."
+  __slots__ = ('name', 'calls', 'wall', 'statements', 'sql_time', 'rows', 'peak_rss')
+
+  def __init__(self, name):
+    self.name = name
+    self.calls = 0
+    self.wall = 0.0
+    self.statements = 0
+    self.sql_time = 0.0
+    self.rows = 0
+    self.peak_rss = 0
+
+  def as_dict(self):
+    return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+class NullProfiler(object):
+  "Used when profiling is off, it records nothing."
+
+  def begin(self, name):
+    pass
+
+  def end(self, rows=0):
+    pass
+
+class Profiler(object):
+  """
+    Records the wall time, the number of SQL statements and the time spent
+    in them, the rows handled and the peak RSS of named phases of a run.
+    Code marks a phase with begin(name) and end(rows), phases with the same
+    name are added up and phases may be nested, the time of an inner phase
+    is part of the outer one too. The statements are counted by wrapping
+    do_execute() and do_executemany() of the dialect of engine, an
+    executemany is one statement. Statements run by other processes, like
+    the report workers, are not counted.
+  """
+
+  def __init__(self, engine, command=None):
+    self.command = command or " ".join(sys.argv)
+    self.phases = []
+    self.statements = 0
+    self.sql_time = 0.0
+    self._by_name = {}
+    self._stack = []
+    self._started = time.time()
+    self.dialect = engine.dialect
+    self._saved = {}
+    for method in ("do_execute", "do_executemany"):
+      self._saved[method] = self.dialect.__dict__.get(method)
+      setattr(self.dialect, method, self._timed(getattr(self.dialect, method)))
+
+  def _timed(self, execute):
+    def timed_execute(*args, **kwargs):
+      ts = time.time()
+      try:
+        return execute(*args, **kwargs)
+      finally:
+        self.statements += 1
+        self.sql_time += time.time() - ts
+    return timed_execute
+
+  def uninstall(self):
+    "Stop counting the statements of the engine."
+    for method, saved in self._saved.items():
+      if saved is None:
+        delattr(self.dialect, method)
+      else:
+        setattr(self.dialect, method, saved)
+
+  def begin(self, name):
+    "Begin a phase, they are listed in the order they were first begun."
+    phase = self._by_name.get(name)
+    if phase is None:
+      phase = self._by_name[name] = Phase(name)
+      self.phases.append(phase)
+    self._stack.append((phase, time.time(), self.statements, self.sql_time))
+
+  def end(self, rows=0):
+    "End the phase that was begun last, rows is the number of rows it handled."
+    phase, started, statements, sql_time = self._stack.pop()
+    phase.calls += 1
+    phase.wall += time.time() - started
+    phase.statements += self.statements - statements
+    phase.sql_time += self.sql_time - sql_time
+    phase.rows += rows
+    phase.peak_rss = max(phase.peak_rss, peak_rss())
+
+  def as_dict(self):
+    "The run as a dict that can be dumped as JSON, see dump()."
+    return { 'command': self.command,
+             'started': self._started,
+             'wall': time.time() - self._started,
+             'statements': self.statements,
+             'sql_time': self.sql_time,
+             'peak_rss': peak_rss(),
+             'phases': [phase.as_dict() for phase in self.phases] }
+
+  def write(self, out):
+    "Write a table of the phases to out."
+    run = self.as_dict()
+    out.write("%-20s %6s %9s %7s %9s %9s %10s\n" % ("Phase", "Calls", "Wall (s)", "SQL", "SQL (s)", "Rows", "RSS (KB)"))
+    for phase in self.phases:
+      out.write("%-20s %6d %9.3f %7d %9.3f %9d %10d\n" % (phase.name, phase.calls, phase.wall, phase.statements, phase.sql_time, phase.rows, phase.peak_rss))
+    out.write("%-20s %6s %9.3f %7d %9.3f %9s %10d\n" % ("Total", "", run['wall'], run['statements'], run['sql_time'], "", run['peak_rss']))
+
+  def dump(self, path):
+    "Write the run as JSON to path, to compare it with other runs."
+    f = file(path, "w")
+    try:
+      json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+      f.write("\n")
+    finally:
+      f.close()
+
+def peak_rss():
+  "The peak resident set size of this process so far, in kilobytes on Linux."
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+_current = NullProfiler()
+
+def current():
+  "Return the profiler of the run, a NullProfiler unless start() was called."
+  return _current
+
+def start(engine, command=None):
+  "Start profiling the run with the DB engine, returns the Profiler."
+  global _current
+  _current = Profiler(engine, command)
+  return _current
+
+def stop():
+  "Stop profiling and return the Profiler, or None if it was not started."
+  global _current
+  profiler = _current
+  _current = NullProfiler()
+  if isinstance(profiler, Profiler):
+    profiler.uninstall()
+    return profiler
+  return None
+
+def add_options(parser):
+  "Add --profile and --profile-json to an OptionParser."
+  parser.add_option("--profile", action="store_true", default=False,
+                    help="print the time, SQL statements, rows and memory of each phase to stderr")
+  parser.add_option("--profile-json", metavar="FILE",
+                    help="write the same numbers as JSON to FILE")
+
+def start_from_options(options, engine):
+  "Start profiling if --profile or --profile-json was given."
+  if options.profile or options.profile_json:
+    start(engine)
+
+def stop_from_options(options):
+  "Stop profiling and print and/or dump the result as the options ask for."
+  profiler = stop()
+  if profiler is None:
+    return
+  if options.profile:
+    profiler.write(sys.stderr)
+  if options.profile_json:
+    profiler.dump(options.profile_json)
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestProfiler(unittest.TestCase):
+
+  def setUp(self):
+    from sqlalchemy import create_engine
+    self.engine = create_engine("sqlite:///:memory:")
+    self.engine.execute("CREATE TABLE t (x INTEGER)")
+    self.profiler = start(self.engine, "test")
+
+  def tearDown(self):
+    stop()
+
+  def testPhases(self):
+    profiler = current()
+    self.assertTrue(profiler is self.profiler)
+    profiler.begin("insert")
+    self.engine.execute("INSERT INTO t VALUES (?)", [(1,), (2,), (3,)])
+    profiler.end(3)
+    for i in range(2):
+      profiler.begin("select")
+      profiler.begin("inner")
+      rows = self.engine.execute("SELECT x FROM t").fetchall()
+      profiler.end(len(rows))
+      profiler.end(len(rows))
+    self.assertEquals(["insert", "select", "inner"], [phase.name for phase in profiler.phases])
+    self.assertEquals([1, 2, 2], [phase.calls for phase in profiler.phases])
+    self.assertEquals([1, 2, 2], [phase.statements for phase in profiler.phases])
+    self.assertEquals([3, 6, 6], [phase.rows for phase in profiler.phases])
+    self.assertTrue(profiler.phases[1].wall >= profiler.phases[2].wall)
+    self.assertTrue(profiler.phases[0].peak_rss > 0)
+    self.assertEquals(3, profiler.statements)
+
+  def testUninstall(self):
+    self.assertTrue(stop() is self.profiler)
+    self.assertEquals(None, stop())
+    self.engine.execute("SELECT x FROM t")
+    self.assertEquals(0, self.profiler.statements)
+    self.assertFalse('do_execute' in self.engine.dialect.__dict__)
+    current().begin("ignored")
+    current().end(1)
+
+  def testDump(self):
+    import os, tempfile
+    from cStringIO import StringIO
+    current().begin("phase")
+    current().end(1)
+    handle, path = tempfile.mkstemp(suffix=".json")
+    os.close(handle)
+    try:
+      self.profiler.dump(path)
+      run = json.load(file(path))
+    finally:
+      os.remove(path)
+    self.assertEquals("test", run['command'])
+    self.assertEquals(["phase"], [phase['name'] for phase in run['phases']])
+    out = StringIO()
+    self.profiler.write(out)
+    self.assertEquals(["Phase", "phase", "Total"], [line.split()[0] for line in out.getvalue().splitlines()])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+reportcache.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import cPickle
+import logging
+import os
+import tempfile
+import unittest
+from hashlib import md5
+
+from sqlalchemy import select
+
+from config import cfg
+from model import *
+import storage
+
+log = logging.getLogger("reportcache")
+
+# Bump when a change of the code changes the reports, it invalidates the cache
+VERSION = 2
+
+# The kinds of entries, results are pickled and report texts kept as they are
+SUFFIXES = (".pickle", ".txt")
+
+def changes():
+  "Return the number of imports that have changed the DB, see ChangeCounter."
+  return _counters()[0]
+
+def task_changes():
+  "Return the number of task rows inserted, updated or deleted, see ChangeCounter."
+  return _counters()[1]
+
+def _counters():
+  t = ChangeCounter.table
+  row = session.execute(select([t.c.changes, t.c.tasks])).fetchone()
+  if row is None:
+    return 0, 0
+  return row[0] or 0, row[1] or 0
+
+def bump_changes():
+  """
+    Count an import that changed the DB, called by the mappers. It is not
+    committed, that is up to the caller.
+  """
+  t = ChangeCounter.table
+  if session.execute(t.update(values={t.c.changes: t.c.changes + 1})).rowcount == 0:
+    session.execute(t.insert(), {'changes': 1})
+
+def config_hash():
+  "Return a digest of the config, the reports depend on it."
+  return md5(repr(sorted(cfg.items()))).hexdigest()
+
+class ReportCache(object):
+  """
+    Report results pickled to files in directory, one file per key, and
+    report texts stored as plain files next to them, so they can be
+    written and read in blocks. The keys include the DB change counters,
+    so a report made before an import or a change of the tasks is never
+    returned after it. The stale files are evicted like any other when the
+    cache has more than max_entries files or max_bytes in total, the least
+    recently used first.
+  """
+
+  def __init__(self, directory=None, max_entries=None, max_bytes=None):
+    if directory is None:
+      directory = cfg.get('cache.dir', "./data/cache")
+    if max_entries is None:
+      max_entries = cfg.get('cache.entries', 500)
+    if max_bytes is None:
+      max_bytes = cfg.get('cache.size', 50 * 1024 * 1024)
+    self.directory = directory
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.hits = 0
+    self.misses = 0
+
+  def key(self, kind, *args):
+    "Return the key of the result of kind (e.g. the report name) for args, in the current DB."
+    state = (VERSION, kind, args, storage.source_url(metadata.bind), config_hash(), _counters())
+    return md5(repr(state)).hexdigest()
+
+  def get(self, key):
+    "Return the result stored at key, None if there is none."
+    path = self._path(key)
+    try:
+      f = file(path, "rb")
+    except IOError:
+      self.misses+=1
+      return None
+    try:
+      try:
+        result = cPickle.load(f)
+      finally:
+        f.close()
+    except (EOFError, cPickle.UnpicklingError), e:
+      log.warning("Removing the broken cache entry %s: %s" % (path, e))
+      self._remove(path)
+      self.misses+=1
+      return None
+    os.utime(path, None)  # Marks it as recently used
+    self.hits+=1
+    return result
+
+  def put(self, key, result):
+    "Store result at key and evict the least recently used entries if the cache is full."
+    self._store(self._path(key), lambda f: cPickle.dump(result, f, cPickle.HIGHEST_PROTOCOL))
+
+  def open_text(self, key):
+    "Return the text stored at key as a file opened for reading, None if there is none."
+    path = self._path(key, ".txt")
+    try:
+      f = file(path, "rb")
+    except IOError:
+      self.misses+=1
+      return None
+    os.utime(path, None)
+    self.hits+=1
+    return f
+
+  def put_text(self, key, write):
+    """
+      Call write with a file and store what it writes as the text at key,
+      then evict like put. Nothing is stored if write raises an exception.
+    """
+    self._store(self._path(key, ".txt"), write)
+
+  def _store(self, path, write):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    handle, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+    f = os.fdopen(handle, "wb")
+    try:
+      try:
+        write(f)
+      finally:
+        f.close()
+    except:
+      self._remove(temp)
+      raise
+    os.rename(temp, path)  # Readers never see a half written entry
+    self.evict()
+
+  def evict(self):
+    "Remove the least recently used entries until the cache is within its limits."
+    entries = []
+    for name in os.listdir(self.directory):
+      if name.endswith(SUFFIXES):
+        path = os.path.join(self.directory, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue  # Evicted by another process
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort(reverse=True)
+    count = 0
+    size = 0
+    for mtime, bytes, path in entries:
+      count += 1
+      size += bytes
+      if count > self.max_entries or size > self.max_bytes:
+        log.debug("Evicting %s" % path)
+        self._remove(path)
+
+  def clear(self):
+    "Remove all entries."
+    if os.path.isdir(self.directory):
+      for name in os.listdir(self.directory):
+        if name.endswith(SUFFIXES):
+          self._remove(os.path.join(self.directory, name))
+
+  def _path(self, key, suffix=".pickle"):
+    return os.path.join(self.directory, key + suffix)
+
+  def _remove(self, path):
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestReportCache(unittest.TestCase):
+
+  def setUp(self):
+    from mapper import CSVDBMapper
+    self.DATAFILE = "testdata/testdata.csv"
+    self.bind = metadata.bind
+    metadata.bind = "sqlite:///:memory:"
+    create_all()
+    CSVDBMapper(self.DATAFILE).map()
+    session.clear()
+    self.period = str(Task.query.order_by(Task.date).first().date)[:7]
+    self.directory = tempfile.mkdtemp()
+    self.cache = ReportCache(self.directory)
+
+  def tearDown(self):
+    import shutil
+    shutil.rmtree(self.directory)
+    session.close()
+    drop_all()
+    metadata.bind = self.bind
+
+  def testGetPut(self):
+    key = self.cache.key("test", self.period)
+    self.assertEquals(None, self.cache.get(key))
+    self.cache.put(key, ("report", {"Office": 1.0}))
+    self.assertEquals(("report", {"Office": 1.0}), self.cache.get(key))
+    self.assertEquals((1, 1), (self.cache.hits, self.cache.misses))
+    self.assertNotEquals(key, self.cache.key("test", "1999-01"))
+    self.assertNotEquals(key, self.cache.key("other", self.period))
+
+  def testInvalidation(self):
+    key = self.cache.key("test", self.period)
+    self.assertEquals(1, changes())
+    bump_changes()
+    session.commit()
+    self.assertEquals(2, changes())
+    self.assertNotEquals(key, self.cache.key("test", self.period))
+    key = self.cache.key("test", self.period)
+    cfg['cache.test'] = 1
+    try:
+      self.assertNotEquals(key, self.cache.key("test", self.period))
+    finally:
+      del cfg['cache.test']
+    self.assertEquals(key, self.cache.key("test", self.period))
+
+  def testImportBumpsChanges(self):
+    from mapper import CSVDBMapper
+    CSVDBMapper(self.DATAFILE).map()  # Every entry is already in the DB
+    self.assertEquals(1, changes())
+
+  def testEviction(self):
+    cache = ReportCache(self.directory, max_entries=3)
+    for i in range(3):
+      cache.put(str(i), i)
+      os.utime(cache._path(str(i)), (i, i))
+    cache.get("0")  # The least recently used is now 1
+    cache.put("3", 3)
+    self.assertEquals([0, None, 2, 3], [cache.get(str(i)) for i in range(4)])
+    cache = ReportCache(self.directory, max_bytes=os.path.getsize(cache._path("3")))
+    cache.put("4", 4)
+    self.assertEquals([None, 4], [cache.get(str(i)) for i in (3, 4)])
+
+  def testText(self):
+    key = self.cache.key("test", self.period)
+    self.assertEquals(None, self.cache.open_text(key))
+    self.cache.put_text(key, lambda f: f.write("report"))
+    f = self.cache.open_text(key)
+    try:
+      self.assertEquals("report", f.read())
+    finally:
+      f.close()
+    self.assertEquals(None, self.cache.get(key), "Texts and results are kept apart")
+    def fail(f):
+      f.write("half a report")
+      raise IOError("Disk full")
+    self.assertRaises(IOError, self.cache.put_text, "failed", fail)
+    self.assertEquals(None, self.cache.open_text("failed"))
+    self.assertEquals(["%s.txt" % key], [name for name in os.listdir(self.directory) if not name.endswith(".pickle")])
+    self.cache.clear()
+    self.assertEquals([], os.listdir(self.directory))
+
+  def testBrokenEntry(self):
+    file(self.cache._path("broken"), "wb").write("not a pickle")
+    self.assertEquals(None, self.cache.get("broken"))
+    self.assertFalse(os.path.exists(self.cache._path("broken")))
+
+  def testMonthlyReport(self):
+    import imp
+    from reporting import QueryCounter
+    report = imp.load_source("monthly_report", "monthly-report.py")
+    expected = report.MonthlyReport(self.period).get_report()
+    first = report.MonthlyReport(self.period)
+    first.cache = self.cache
+    self.assertEquals(expected, first.get_report())
+    counter = QueryCounter(metadata.bind)
+    try:
+      second = report.MonthlyReport(self.period)
+      second.cache = self.cache
+      self.assertEquals(expected, second.get_report())
+      self.assertEquals(first.totals, second.totals)
+      self.assertEquals(1, counter.count, "Only the change counter should be read")
+    finally:
+      counter.uninstall()
+
+  def testRangeReport(self):
+    import imp, shutil
+    from reporting import QueryCounter
+    report = imp.load_source("monthly_report", "monthly-report.py")
+    last = "%s-12" % self.period[:4]
+    directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    try:
+      expected = report.RangeReport(self.period, last, cache=self.cache).write_reports(directories[0])
+      counter = QueryCounter(metadata.bind)
+      try:
+        paths = report.RangeReport(self.period, last, cache=self.cache).write_reports(directories[1])
+        self.assertEquals([], [s for s in counter.statements if "FROM model_task" in s], "The tasks should not be read")
+      finally:
+        counter.uninstall()
+      self.assertEquals([os.path.basename(path) for path in expected], [os.path.basename(path) for path in paths])
+      for first, second in zip(expected, paths):
+        self.assertEquals(file(first).read(), file(second).read())
+    finally:
+      for directory in directories:
+        shutil.rmtree(directory)
+
+  def testStatistics(self):
+    from statistics_month import Statistics, DateModel
+    employee = Employee.query.first().name
+    expected = Statistics(DateModel("%s-01" % self.period)).by_employee(employee)
+    self.assertEquals(expected, Statistics(DateModel("%s-01" % self.period), self.cache).by_employee(employee))
+    self.assertEquals(expected, Statistics(DateModel("%s-01" % self.period), self.cache).by_employee(employee))
+    self.assertEquals(1, self.cache.hits)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+reporting.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import imp
+import os
+import unittest
+from bisect import bisect_right
+
+from sqlalchemy import and_, create_engine, func, select
+from sqlalchemy.interfaces import PoolListener
+
+from model import *
+import storage
+
+class TaskRow(object):
+  """
+    A read-only view of a Task together with the names of its employee,
+    project and customer, fetched in the same query as the task. Used by
+    the reports instead of Task entities to avoid lazy loading.
+  """
+  __slots__ = ('id', 'employee', 'customer', 'project', 'name', 'date', 'hours', 'billable')
+
+  def __init__(self,id,employee,customer,project,name,date,hours,billable):
+    self.id = id
+    self.employee = employee
+    self.customer = customer
+    self.project = project
+    self.name = name
+    self.date = date
+    self.hours = hours
+    self.billable = billable
+
+  def __eq__(self, other):
+    return isinstance(other, TaskRow) and [getattr(self, name) for name in self.__slots__] == [getattr(other, name) for name in other.__slots__]
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return '<TaskRow "%s - %s %0.2f hours at %s">' % (self.date, self.employee, self.hours, self.name)
+
+class PORow(object):
+  "A read-only copy of a PurchaseOrder, see POIndex."
+  __slots__ = ('id', 'employee', 'number', 'start', 'stop', 'price', 'customer', 'reference')
+
+  def __init__(self,id,employee,number,start,stop,price,customer,reference):
+    self.id = id
+    self.employee = employee
+    self.number = number
+    self.start = start
+    self.stop = stop
+    self.price = price
+    self.customer = customer
+    self.reference = reference
+
+class POIndex(object):
+  """
+    All purchase orders, or those of the employees in a list of names,
+    loaded with one query and indexed by employee, for the reports. Each
+    employee's orders are sorted by start date, with the latest stop date
+    seen so far next to each, so the orders that overlap a period are
+    found with a binary search and a backwards scan that ends at the first
+    order where that stop date is before the period. The orders are also
+    kept in id order, and each start sorted order knows its place there,
+    so the result only has to sort those places.
+  """
+
+  def __init__(self, employees=None):
+    po = PurchaseOrder.table
+    clauses = [po.c.start != None, po.c.stop != None]
+    if employees is not None:
+      clauses.append(po.c.employee_name.in_(employees))
+    q = select([po.c.id, po.c.employee_name, po.c.number, po.c.start, po.c.stop, po.c.price, po.c.customer, po.c.reference],
+               and_(*clauses), order_by=[po.c.start, po.c.id])
+    self._orders = {}
+    for row in session.execute(q):
+      self._orders.setdefault(row[1], []).append(PORow(*row))
+    for employee, orders in self._orders.items():
+      by_id = sorted(orders, key=lambda order: order.id)
+      places = dict([(order.id, place) for place, order in enumerate(by_id)])
+      max_stops = []
+      for order in orders:
+        if max_stops and max_stops[-1] > order.stop:
+          max_stops.append(max_stops[-1])
+        else:
+          max_stops.append(order.stop)
+      self._orders[employee] = ([order.start for order in orders], max_stops,
+                                [places[order.id] for order in orders], by_id)
+
+  def overlapping(self, employee, start, stop):
+    "Return the orders of employee that overlap start to stop (dates), in id order."
+    if employee not in self._orders:
+      return []
+    starts, max_stops, places, by_id = self._orders[employee]
+    found = []
+    i = bisect_right(starts, stop)
+    while i > 0 and max_stops[i - 1] >= start:
+      i -= 1
+      if by_id[places[i]].stop >= start:
+        found.append(places[i])
+    found.sort()
+    return [by_id[place] for place in found]
+
+def _where(start, stop, employee=None, project=None, employees=None):
+  "The clauses shared by all task queries, joining task, project and customer."
+  t, p, c = Task.table, Project.table, Customer.table
+  clauses = [t.c.date >= start, t.c.date <= stop, t.c.project_id == p.c.id, p.c.customer_id == c.c.id]
+  if employee is not None:
+    clauses.append(t.c.employee_name == employee)
+  if employees is not None:
+    clauses.append(t.c.employee_name.in_(employees))
+  if project is not None:
+    clauses.append(p.c.name == project)
+  return and_(*clauses)
+
+def task_rows(start, stop, employee=None, project=None, employees=None):
+  """
+    Return the tasks from start to stop (inclusive), optionally for a
+    single employee, the employees in a list of names and/or a project
+    name, as a list of TaskRow in the order they were added.
+  """
+  t, p, c = Task.table, Project.table, Customer.table
+  q = select([t.c.id, t.c.employee_name, c.c.name, p.c.name, t.c.name, t.c.date, t.c.hours, t.c.billable],
+             _where(start, stop, employee, project, employees), order_by=[t.c.id])
+  return [TaskRow(*row) for row in session.execute(q)]
+
+def rows_by_employee(rows):
+  "Split a list of TaskRow into a dict with the employee name as key."
+  result = {}
+  for row in rows:
+    result.setdefault(row.employee, []).append(row)
+  return result
+
+def month_entries(start, stop, employees=None):
+  """
+    Sum the hours from start to stop by employee, customer, project and
+    task in one GROUP BY query, optionally only for the employees in a list
+    of names. Returns a dict with the employee name as key and utf-8
+    encoded customer -> project -> task -> hours dicts as values. The
+    groups are added in the order of their first task, just as if the
+    tasks had been added one by one.
+  """
+  t, p, c = Task.table, Project.table, Customer.table
+  q = select([t.c.employee_name, c.c.name, p.c.name, t.c.name, func.sum(t.c.hours)],
+             _where(start, stop, employees=employees),
+             group_by=[t.c.employee_name, c.c.name, p.c.name, t.c.name],
+             order_by=[t.c.employee_name, func.min(t.c.id)])
+  return nested_entries(session.execute(q))
+
+def sum_entries(rows):
+  """
+    The same as month_entries() but summed in memory from a list of TaskRow
+    in id order.
+  """
+  result = {}
+  for row in rows:
+    projects = result.setdefault(row.employee, {}).setdefault(row.customer.encode("utf-8"), {})
+    tasks = projects.setdefault(row.project.encode("utf-8"), {})
+    name = row.name.encode("utf-8")
+    tasks[name] = tasks.get(name, 0) + row.hours
+  return result
+
+def nested_entries(rows):
+  """
+    Turn (employee, customer, project, task, hours) rows into the dict
+    returned by month_entries(), in the order of the rows.
+  """
+  result = {}
+  for employee, customer, project, task_name, hours in rows:
+    customer = customer.encode("utf-8")
+    project = project.encode("utf-8")
+    task_name = task_name.encode("utf-8")
+    result.setdefault(employee, {}).setdefault(customer, {}).setdefault(project, {})[task_name] = hours
+  return result
+
+class ReadOnlyListener(PoolListener):
+  "Makes every new SQLite connection of a pool refuse to write."
+
+  def connect(self, dbapi_con, con_record):
+    dbapi_con.execute("PRAGMA query_only = 1")
+
+def read_only_engine(engine):
+  """
+    Return a new engine for the DB of engine whose connections are
+    read-only. For a memory engine it is the file the DB was loaded from.
+  """
+  return create_engine(storage.source_url(engine), listeners=[ReadOnlyListener()])
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class QueryCounter(object):
+  "Counts the statements executed by an engine until uninstall() is called."
+
+  def __init__(self, engine):
+    self.count = 0
+    self.statements = []
+    self.dialect = engine.dialect
+    execute = self.dialect.do_execute
+    def counting_execute(cursor, statement, *args, **kwargs):
+      self.count+=1
+      self.statements.append(statement)
+      return execute(cursor, statement, *args, **kwargs)
+    self.dialect.do_execute = counting_execute
+
+  def uninstall(self):
+    del self.dialect.do_execute
+
+class TestReporting(unittest.TestCase):
+
+  def setUp(self):
+    from mapper import CSVDBMapper
+    self.DATAFILE = "testdata/testdata.csv"
+    self.bind = metadata.bind
+    metadata.bind = "sqlite:///:memory:"
+    create_all()
+    CSVDBMapper(self.DATAFILE).map()
+    session.clear()
+    first = Task.query.order_by(Task.date).first()
+    self.start = "%d-%02d-01" % (first.date.year, first.date.month)
+    self.stop = "%d-%02d-31" % (first.date.year, first.date.month)
+    self.employee = first.employee.name
+    session.clear()
+    self.counter = QueryCounter(metadata.bind)
+
+  def tearDown(self):
+    self.counter.uninstall()
+    session.close()
+    drop_all()
+    metadata.bind = self.bind
+
+  def testTaskRows(self):
+    rows = task_rows(self.start, self.stop)
+    self.assertEquals(1, self.counter.count)
+    self.assertNotEquals(0, len(rows))
+    tasks = Task.query.filter(Task.date >= self.start).filter(Task.date <= self.stop).order_by(Task.id).all()
+    for row, task in zip(rows, tasks):
+      self.assertEquals((task.employee.name, task.project.customer.name, task.project.name, task.name, task.hours),
+                        (row.employee, row.customer, row.project, row.name, row.hours))
+
+  def testPOIndex(self):
+    from datetime import date
+    employee = Employee.get(self.employee)
+    for number, (start, stop) in enumerate([((2009, 3, 1), (2009, 12, 31)), ((2008, 1, 1), (2008, 12, 31)),
+                                            ((2009, 5, 10), (2009, 5, 20)), ((2009, 1, 1), (2009, 3, 31)),
+                                            ((2007, 6, 1), (2007, 6, 30)), ((2007, 1, 1), (2008, 6, 30))]):
+      PurchaseOrder(number=number, start=date(*start), stop=date(*stop), price=900, customer=u"C", reference=u"R", employee=employee)
+    PurchaseOrder(number=6, start=None, stop=None, price=900, customer=u"C", reference=u"R", employee=employee)
+    session.commit()
+    self.counter.count = 0
+    index = POIndex()
+    self.assertEquals(1, self.counter.count)
+    for start, stop in [((2009, 5, 1), (2009, 5, 31)), ((2008, 12, 31), (2009, 1, 1)), ((2009, 4, 1), (2009, 4, 30)),
+                        ((2007, 1, 1), (2007, 12, 31)), ((2009, 5, 20), (2009, 5, 20))]:
+      start, stop = date(*start), date(*stop)
+      pos = PurchaseOrder.query.filter(PurchaseOrder.start <= stop).filter(PurchaseOrder.stop >= start)
+      pos = pos.filter(PurchaseOrder.employee == employee).order_by(PurchaseOrder.id).all()
+      self.assertEquals([po.id for po in pos], [po.id for po in index.overlapping(self.employee, start, stop)])
+    self.assertEquals([], index.overlapping(u"Nobody", date(2009, 1, 1), date(2009, 12, 31)))
+
+  def testStatistics(self):
+    from statistics_month import Statistics, DateModel
+    Statistics(DateModel(self.start)).by_employee(self.employee)
+    # One to check that the rollups are current and one to read them
+    self.assertEquals(2, self.counter.count)
+
+  def testMonthlyReport(self):
+    report = imp.load_source("monthly_report", "monthly-report.py")
+    employees = Employee.query.count()
+    self.counter.count = 0
+    report.MonthlyReport(self.start[:7]).get_report()
+    # Employees, offices, rollup check, month, weeks, internal tasks and POs
+    self.assertEquals(7, self.counter.count)
+
+  def testWriteReport(self):
+    from cStringIO import StringIO
+    report = imp.load_source("monthly_report", "monthly-report.py").MonthlyReport(self.start[:7])
+    out = StringIO()
+    report.write_report(out)
+    self.assertEquals(report.get_report(), out.getvalue())
+    self.assertTrue(out.getvalue().startswith("Billing report for %s" % self.start))
+
+  def testRangeReport(self):
+    import shutil, tempfile
+    report = imp.load_source("monthly_report", "monthly-report.py")
+    months = report._months(self.start[:7], "%d-12" % int(self.start[:4]))
+    directory = tempfile.mkdtemp()
+    try:
+      self.counter.statements = []
+      paths = report.RangeReport(months[0], months[-1]).write_reports(directory)
+      scans = [statement for statement in self.counter.statements if "FROM model_task" in statement]
+      self.assertEquals(1, len(scans), "The tasks should be read once")
+      self.assertEquals(os.path.join(directory, "%s..%s.txt" % (months[0], months[-1])), paths[-1])
+      for path in paths[:-1]:
+        period = os.path.basename(path)[:7]
+        self.assertEquals(report.MonthlyReport(period).get_report() + "\n", file(path).read())
+    finally:
+      shutil.rmtree(directory)
+
+
+class TestParallelReport(unittest.TestCase):
+
+  def setUp(self):
+    import tempfile
+    from mapper import CSVDBMapper
+    self.DATAFILE = "testdata/testdata.csv"
+    self.bind = metadata.bind
+    # The workers open their own connections, so the DB must be a file
+    handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(handle)
+    metadata.bind = "sqlite:///%s" % self.path
+    create_all()
+    CSVDBMapper(self.DATAFILE).map()
+    session.clear()
+    self.period = str(Task.query.order_by(Task.date).first().date)[:7]
+
+  def tearDown(self):
+    session.close()
+    metadata.bind.dispose()
+    metadata.bind = self.bind
+    os.remove(self.path)
+
+  def testSameAsSerial(self):
+    report = imp.load_source("monthly_report", "monthly-report.py")
+    self.assertEquals(report.MonthlyReport(self.period).get_report(),
+                      report.MonthlyReport(self.period, 3).get_report())
+
+  def testSameAsSerialFromTasks(self):
+    report = imp.load_source("monthly_report", "monthly-report.py")
+    session.execute(RollupState.table.delete())  # Makes the rollups stale
+    session.commit()
+    self.assertEquals(report.MonthlyReport(self.period).get_report(),
+                      report.MonthlyReport(self.period, 3).get_report())
+
+  def testReadOnly(self):
+    engine = read_only_engine(metadata.bind)
+    self.assertRaises(Exception, engine.execute, Task.table.delete())
+    engine.dispose()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+rollup.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import unittest
+
+from sqlalchemy import and_, bindparam, func, or_, select
+
+from model import *
+import reportcache
+import reporting
+
+log = logging.getLogger("rollup")
+
+def last_task():
+  "Return the id of the last task included in the rollups, 0 if none is."
+  return _state()[0]
+
+def _state():
+  "The last task and the ChangeCounter.tasks of the last update of the rollups."
+  row = session.execute(select([RollupState.table.c.last_task, RollupState.table.c.tasks])).fetchone()
+  if row is None:
+    return 0, 0
+  return row[0] or 0, row[1] or 0
+
+def is_current():
+  """
+    True if the rollups are up to date with the tasks in the DB, i.e. no
+    task has been inserted, updated or deleted since they were updated
+    (see ChangeCounter.tasks). Tasks that were changed without a mapper
+    are not included until the next import or rebuild().
+  """
+  r, c = RollupState.table, ChangeCounter.table
+  state = [select([column]).as_scalar() for column in (r.c.last_task, r.c.tasks, c.c.tasks)]
+  row = session.execute(select([func.max(Task.table.c.id)] + state)).fetchone()
+  last, rolled, counted, changes = [value or 0 for value in row]
+  return last == rolled and counted == changes
+
+def update():
+  """
+    Add the tasks with an id above last_task() to the month and week
+    rollups. Called by the Harvest mappers before every commit, so the
+    rollups are committed together with the tasks. If anything but the
+    new tasks has changed since the last update the rollups are computed
+    again from all tasks. Returns the number of tasks that were added.
+  """
+  t = Task.table
+  last, counted = _state()
+  changes = reportcache.task_changes()
+  added = session.execute(select([func.count(t.c.id)], t.c.id > last)).scalar()
+  if counted + added != changes:
+    log.info("The tasks have changed since the rollups were updated, computing them again")
+    session.execute(MonthRollup.table.delete())
+    session.execute(WeekRollup.table.delete())
+    last = 0
+  return _add_tasks(last, changes)
+
+def _add_tasks(last, changes):
+  "Add the tasks with an id above last to the rollups, they are then current at changes."
+  t = Task.table
+  months = {}
+  weeks = {}
+  count = 0
+  q = select([t.c.id, t.c.employee_name, t.c.project_id, t.c.name, t.c.date, t.c.hours],
+             t.c.id > last, order_by=[t.c.id])
+  for id, employee, project, name, date, hours in session.execute(q):
+    year, week = date.isocalendar()[:2]
+    _add(months, (employee, project, name, date.year, date.month), id, hours)
+    _add(weeks, (employee, project, name, year, week), id, hours)
+    last = id
+    count+=1
+
+  if count > 0:
+    _merge(MonthRollup.table, 'month', months)
+    _merge(WeekRollup.table, 'week', weeks)
+    log.debug("Added %d tasks to the rollups" % count)
+  if (last, changes) != _state():
+    session.execute(RollupState.table.delete())
+    session.execute(RollupState.table.insert(), {'last_task': last, 'tasks': changes})
+  return count
+
+def rebuild():
+  "Throw away the rollups and compute them again from all tasks."
+  session.execute(MonthRollup.table.delete())
+  session.execute(WeekRollup.table.delete())
+  count = _add_tasks(0, reportcache.task_changes())
+  session.commit()
+  return count
+
+def _add(groups, key, id, hours):
+  group = groups.get(key)
+  if group is None:
+    groups[key] = [hours, id]
+  else:
+    group[0] += hours
+
+def _merge(table, period, groups):
+  """
+    Add the hours in groups, (employee, project, name, year, period) ->
+    [hours, first task], to the rows of table. Only the rows of the periods
+    in groups are read.
+  """
+  existing = {}
+  for year, number in set([key[3:] for key in groups.keys()]):
+    q = select([table.c.id, table.c.employee_name, table.c.project_id, table.c.name, table.c.hours],
+               and_(table.c.year == year, table.c[period] == number))
+    for id, employee, project, name, hours in session.execute(q):
+      existing[(employee, project, name, year, number)] = (id, hours)
+
+  inserts = []
+  updates = []
+  for key, (hours, first_task) in groups.items():
+    if key in existing:
+      id, old = existing[key]
+      updates.append({'rollup_id': id, 'hours': old + hours})
+    else:
+      employee, project, name, year, number = key
+      inserts.append({'employee_name': employee, 'project_id': project, 'name': name,
+                      'year': year, period: number, 'hours': hours, 'first_task': first_task})
+  if inserts:
+    session.execute(table.insert(), inserts)
+  if updates:
+    session.execute(table.update(table.c.id == bindparam('rollup_id')), updates)
+
+def month_entries(year, month, employees=None):
+  "The same as reporting.month_entries() for a whole month, read from the rollups."
+  r, p, c = MonthRollup.table, Project.table, Customer.table
+  clauses = [r.c.year == year, r.c.month == month, r.c.project_id == p.c.id, p.c.customer_id == c.c.id]
+  if employees is not None:
+    clauses.append(r.c.employee_name.in_(employees))
+  q = select([r.c.employee_name, c.c.name, p.c.name, r.c.name, func.sum(r.c.hours)],
+             and_(*clauses),
+             group_by=[r.c.employee_name, c.c.name, p.c.name, r.c.name],
+             order_by=[r.c.employee_name, func.min(r.c.first_task)])
+  return reporting.nested_entries(session.execute(q))
+
+def task_hours(employee, year, month):
+  "The hours of employee in a month summed by task name, in order of the first task."
+  return dict(task_hour_rows(employee, year, month))
+
+def task_hour_rows(employee, year, month):
+  "The same as task_hours() but as a list of (task name, hours) in order of the first task."
+  r = MonthRollup.table
+  q = select([r.c.name, func.sum(r.c.hours)],
+             and_(r.c.employee_name == employee, r.c.year == year, r.c.month == month),
+             group_by=[r.c.name], order_by=[func.min(r.c.first_task)])
+  return [tuple(row) for row in session.execute(q)]
+
+def week_rows(weeks, employees=None):
+  """
+    Return the week rollups of weeks, a list of (ISO year, week) tuples, as
+    (year, week, TaskRow) with the summed hours, optionally only for the
+    employees in a list of names. The rows have no date and their id is
+    the first task of the group.
+  """
+  if not weeks:
+    return []
+  r, p, c = WeekRollup.table, Project.table, Customer.table
+  clauses = [or_(*[and_(r.c.year == year, r.c.week == week) for year, week in weeks]),
+             r.c.project_id == p.c.id, p.c.customer_id == c.c.id]
+  if employees is not None:
+    clauses.append(r.c.employee_name.in_(employees))
+  q = select([r.c.year, r.c.week, r.c.first_task, r.c.employee_name, c.c.name, p.c.name, r.c.name, r.c.hours],
+             and_(*clauses), order_by=[r.c.first_task])
+  return [(row[0], row[1], reporting.TaskRow(*(tuple(row[2:7]) + (None, row[7], None)))) for row in session.execute(q)]
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestRollup(unittest.TestCase):
+
+  def setUp(self):
+    from mapper import CSVDBMapper
+    self.DATAFILE = "testdata/testdata.csv"
+    self.bind = metadata.bind
+    metadata.bind = "sqlite:///:memory:"
+    create_all()
+    mapper = CSVDBMapper(self.DATAFILE)
+    mapper.batchsize = 50  # Make the batches merge into existing rollups
+    mapper.map()
+    session.clear()
+    self.months = set([(task.date.year, task.date.month) for task in Task.query.all()])
+    session.clear()
+
+  def tearDown(self):
+    session.close()
+    drop_all()
+    metadata.bind = self.bind
+
+  def _dump(self):
+    rows = []
+    for table in (MonthRollup.table, WeekRollup.table):
+      rows += [tuple(row)[1:] for row in session.execute(table.select())]
+    rows.sort()
+    return rows
+
+  def testMonthEntries(self):
+    self.assertTrue(is_current())
+    for year, month in self.months:
+      start = "%d-%02d-01" % (year, month)
+      stop = "%d-%02d-31" % (year, month)
+      self.assertEquals(reporting.month_entries(start, stop), month_entries(year, month))
+
+  def testTaskHours(self):
+    from statistics_month import Statistics, DateModel
+    for year, month in self.months:
+      stats = Statistics(DateModel("%d-%02d-01" % (year, month)))
+      for employee in Employee.query.all():
+        tasks = reporting.task_rows(stats.start, stats.stop, employee.name)
+        self.assertEquals(stats._aggregate_tasks(tasks), task_hours(employee.name, year, month))
+
+  def testWeekRows(self):
+    weeks = set([task.date.isocalendar()[:2] for task in Task.query.all()])
+    hours = sum([row.hours for year, week, row in week_rows(list(weeks))])
+    self.assertAlmostEquals(sum([task.hours for task in Task.query.all()]), hours)
+
+  def testRebuild(self):
+    rows = self._dump()
+    self.assertNotEquals(0, len(rows))
+    rebuild()
+    self.assertEquals(rows, self._dump())
+
+  def testStale(self):
+    task = Task.query.first()
+    session.execute(Task.table.insert(), {'name': task.name, 'date': task.date, 'hours': 1.0,
+                                          'employee_name': task.employee.name, 'project_id': task.project.id})
+    self.assertFalse(is_current())
+    self.assertEquals(1, update())
+    self.assertTrue(is_current())
+
+  def testChanged(self):
+    rows = self._dump()
+    last = Task.query.order_by(Task.id.desc()).first()
+    values = {'name': last.name, 'date': last.date, 'hours': last.hours, 'billable': last.billable,
+              'employee_name': last.employee.name, 'project_id': last.project.id}
+    session.clear()
+    # SQLite gives the next task the id of the deleted one
+    session.execute(Task.table.delete(Task.table.c.id == last.id))
+    session.execute(Task.table.insert(), dict(values, hours=values['hours'] + 1))
+    self.assertFalse(is_current())
+    self.assertEquals(Task.query.count(), update())
+    self.assertTrue(is_current())
+    self.assertNotEquals(rows, self._dump())
+    session.execute(Task.table.update(Task.table.c.id == last.id), {'hours': values['hours']})
+    self.assertFalse(is_current())
+    update()
+    self.assertEquals(rows, self._dump())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -25,23 +25,55 @@ along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 import calendar
 import time
 import sys
+from optparse import OptionParser
 
 from model import *
+import profiling
+import reporting
+import rollup
 
 class Statistics(object):
+  """
+    The hours of the month of datemodel. The results are kept in cache, a
+    reportcache.ReportCache, if it is given.
+  """
 
-  def __init__(self,datemodel):
+  def __init__(self,datemodel,cache=None):
     if not isinstance(datemodel, DateModel):
       raise Exception, "This class needs a DateModel instance as first argument"
     self.date = datemodel
+    self.cache = cache
     self.start = self.date.get_month_start()
     self.stop = self.date.get_month_stop()
 
   def by_employee(self,employee):
-    tasks = Task.query.filter(Task.date >= self.start)
-    tasks = tasks.filter(Task.date <= self.stop)
-    tasks = tasks.filter(Task.employee.has(name=employee))
-    return self._aggregate_tasks(tasks)
+    profiling.current().begin("statistics")
+    if self.cache is None:
+      hours = self._hours(employee)
+    else:
+      key = self.cache.key("statistics", self.start, employee)
+      hours = self.cache.get(key)
+      if hours is None:
+        hours = self._hours(employee)
+        self.cache.put(key, hours)
+    profiling.current().end(len(hours))
+    return dict(hours)
+
+  def _hours(self,employee):
+    """
+      The hours of employee by task name as a list of (name, hours) in order
+      of the first task. A dict made from the list lists its keys in the
+      same order as one made from the tasks, an unpickled dict may not.
+    """
+    if rollup.is_current():
+      return rollup.task_hour_rows(employee, self.date.year, self.date.month)
+    tasks = reporting.task_rows(self.start, self.stop, employee)
+    hours = self._aggregate_tasks(tasks)
+    result = []
+    for task in tasks:
+      if hours.has_key(task.name):
+        result.append((task.name, hours.pop(task.name)))
+    return result
 
   def by_task(self,name):
     pass
@@ -71,8 +103,7 @@ class DateModel(object):
     self.year =  int(self.date.split("-")[0])
     self.month = int(self.date.split("-")[1])
     self.day = int(self.date.split("-")[2])
-    self.cal = calendar.Calendar()
-    self.days = max(self.cal.itermonthdays(self.year,self.month))
+    self.days = calendar.monthrange(self.year,self.month)[1]
 
   def get_month_start(self):
     return  "%d-%02d-01" % (self.year,self.month)
@@ -96,13 +127,27 @@ class DateModel(object):
 
 
 if __name__ == "__main__":
-  mod = DateModel(sys.argv[2]) # Create a date model with current date as seed.
-  stats = Statistics(mod)
+  import reportcache
+  parser = OptionParser(usage="statistics_month.py [options] <employee> YYYY-MM-DD")
+  parser.add_option("--no-cache", dest="cache", action="store_false", default=True,
+                    help="neither read nor write the report cache")
+  profiling.add_options(parser)
+  (options, args) = parser.parse_args()
+  if len(args) != 2:
+    parser.print_usage()
+    sys.exit(1)
+  profiling.start_from_options(options, metadata.bind)
+  mod = DateModel(args[1]) # Create a date model with current date as seed.
+  cache = None
+  if options.cache:
+    cache = reportcache.ReportCache()
+  stats = Statistics(mod, cache)
   print "Start %s, Stop %s" % (mod.get_month_start(), mod.get_month_stop())
-  stat = stats.by_employee(unicode(sys.argv[1], 'utf-8'))
+  stat = stats.by_employee(unicode(args[0], 'utf-8'))
   total = 0
   print "Hours by task:"
   for act, hours in stat.items():
     print " - %s: %0.2f" % (act, hours)
     total += hours
   print "Totalt hours: %0.2f" % total
+  profiling.stop_from_options(options)
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+storage.py
+
+Created by Emil Erlandsson <emil@purplescout.se> on 2009-05-13.
+Copyright (c) 2009 Purple Scout AB. All rights reserved.
+
+This file is part of HarvestUtils.
+
+HarvestUtils is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+HarvestUtils is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import logging
+import os
+import time
+import unittest
+import weakref
+
+import sqlalchemy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.interfaces import PoolListener
+
+log = logging.getLogger("storage")
+
+# How the SQLite DB of cfg['db.bind'] is used, cfg['db.mode'] picks one:
+#  default - the file with the default settings of SQLite
+#  fast    - the file with a write-ahead log, less syncing and larger caches
+#  memory  - an in-memory copy of the file, see load() and save()
+MODES = ("default", "fast", "memory")
+
+# The first SQLite that has VACUUM INTO, save() copies the tables on older ones
+VACUUM_INTO = (3, 27, 0)
+
+class SQLiteTuning(PoolListener):
+  """
+    Tunes every new SQLite connection of a pool for throughput. The
+    write-ahead log is a setting of the file, it stays on for the
+    connections of other modes until journal_mode is set back to DELETE.
+    With synchronous=NORMAL a power loss can undo the last transactions,
+    but not corrupt the DB.
+  """
+
+  def __init__(self, cache_size, mmap_size):
+    self.cache_size = cache_size
+    self.mmap_size = mmap_size
+
+  def connect(self, dbapi_con, con_record):
+    dbapi_con.execute("PRAGMA journal_mode = WAL")
+    dbapi_con.execute("PRAGMA synchronous = NORMAL")
+    dbapi_con.execute("PRAGMA cache_size = -%d" % self.cache_size)  # In KB when negative
+    dbapi_con.execute("PRAGMA mmap_size = %d" % self.mmap_size)
+
+# The file each in-memory engine was loaded from, by engine
+_sources = weakref.WeakKeyDictionary()
+
+def create_engine(url, mode="default", cfg=None):
+  """
+    Return an engine for the SQLite DB at url in mode, one of MODES. The
+    sizes of the fast mode are taken from cfg, 'db.cache_size' in KB and
+    'db.mmap_size' in bytes. A memory engine starts out empty, see load().
+  """
+  cfg = cfg or {}
+  if mode == "default":
+    return sqlalchemy.create_engine(url)
+  elif mode == "fast":
+    tuning = SQLiteTuning(cfg.get('db.cache_size', 64 * 1024), cfg.get('db.mmap_size', 256 * 1024 * 1024))
+    return sqlalchemy.create_engine(url, listeners=[tuning])
+  elif mode == "memory":
+    engine = sqlalchemy.create_engine("sqlite://")
+    _sources[engine] = url
+    return engine
+  raise Exception, "Unknown DB mode %r, it should be one of %s" % (mode, ", ".join(MODES))
+
+def source_url(engine):
+  "Return the URL of the DB engine holds, the file it was loaded from for a memory engine."
+  return _sources.get(engine, str(engine.url))
+
+def is_memory(engine):
+  return engine in _sources
+
+def bind(metadata, url, mode="default", cfg=None):
+  """
+    Bind metadata to a new engine for url in mode and create the missing
+    tables. A memory engine is loaded from the file at url. Returns the
+    engine.
+  """
+  engine = create_engine(url, mode, cfg)
+  metadata.bind = engine
+  metadata.create_all()
+  if mode == "memory":
+    load(engine, metadata, url)
+  return engine
+
+def _path(url):
+  return make_url(url).database
+
+def load(engine, metadata, url):
+  """
+    Copy all rows of the tables of metadata from the SQLite file at url into
+    the (empty) DB of engine, one INSERT ... SELECT per table. Columns that
+    the file does not have are left NULL. The triggers of the DB are
+    dropped while the rows are copied, so they do not fire on them.
+    Returns the number of rows.
+  """
+  path = _path(url)
+  if not os.path.exists(path):
+    return 0  # ATTACH would create it
+  ts = time.time()
+  rows = 0
+  con = engine.raw_connection()
+  try:
+    triggers = con.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall()
+    for name, sql in triggers:
+      con.execute("DROP TRIGGER %s" % name)
+    con.execute("ATTACH DATABASE ? AS disk", (path,))
+    try:
+      for table in metadata.table_iterator(reverse=False):
+        existing = [row[1] for row in con.execute("PRAGMA disk.table_info(%s)" % table.name)]
+        columns = ", ".join([column.name for column in table.columns if column.name in existing])
+        if columns:
+          rows += con.execute("INSERT INTO main.%s (%s) SELECT %s FROM disk.%s" % (table.name, columns, columns, table.name)).rowcount
+      for name, sql in triggers:
+        con.execute(sql)
+      con.commit()
+    finally:
+      con.execute("DETACH DATABASE disk")
+  finally:
+    con.close()
+  log.info("Loaded %d rows from %s in %0.2f seconds" % (rows, path, time.time() - ts))
+  return rows
+
+def save(engine, url):
+  """
+    Write the DB of engine to the SQLite file at url, replacing it. The copy
+    is written next to it, with VACUUM INTO or by copying the tables on an
+    SQLite older than VACUUM_INTO, and renamed over it, so readers see
+    either the old or the new DB. A file left in the write-ahead log mode
+    by the fast mode is checkpointed and set back to journal_mode DELETE
+    first, which no other process may have it open for. Then it is locked
+    exclusively, which keeps out the readers too, until it is replaced.
+  """
+  path = _path(url)
+  ts = time.time()
+  dbapi = engine.dialect.dbapi
+  lock = None
+  if os.path.exists(path):
+    lock = dbapi.connect(path, timeout=1, isolation_level=None)
+    try:
+      if lock.execute("PRAGMA journal_mode").fetchone()[0] == "wal":
+        lock.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if lock.execute("PRAGMA journal_mode = DELETE").fetchone()[0] != "delete":
+          raise dbapi.OperationalError, "it is in the write-ahead log mode"
+      lock.execute("BEGIN EXCLUSIVE")
+    except dbapi.OperationalError, e:
+      lock.close()
+      raise Exception, "The DB %s is in use (%s), it can not be replaced" % (path, e)
+  try:
+    temp = path + ".saving"
+    if os.path.exists(temp):
+      os.remove(temp)
+    con = engine.raw_connection()
+    try:
+      con.commit()
+      if dbapi.sqlite_version_info >= VACUUM_INTO:
+        con.execute("VACUUM INTO ?", (temp,))
+      else:
+        _copy_into(dbapi, con, temp)
+    finally:
+      con.close()
+    os.rename(temp, path)
+  finally:
+    if lock is not None:
+      lock.close()  # Ends the transaction, and the lock, of the old file
+  for suffix in ("-wal", "-shm"):
+    if os.path.exists(path + suffix):
+      os.remove(path + suffix)  # Left by the old file, they would be applied to the new one
+  log.info("Saved the DB to %s in %0.2f seconds" % (path, time.time() - ts))
+
+def close(engine):
+  """
+    Close the connections of engine. When the file is in the write-ahead
+    log mode of the fast mode the log is checkpointed into it and
+    truncated first, so the file holds the whole DB.
+  """
+  if engine.execute("PRAGMA journal_mode").scalar() == "wal":
+    engine.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+  engine.dispose()
+
+def _copy_into(dbapi, con, path):
+  """
+    Copy the DB of the connection con to a new SQLite file at path: the
+    tables, then their rows, then the indexes and triggers, so the triggers
+    do not fire on the copied rows.
+  """
+  schema = con.execute("SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'").fetchall()
+  tables = [name for type, name, sql in schema if type == "table"]
+  # The statements do not name a database, so they are run on the file itself
+  _execute(dbapi, path, [sql for type, name, sql in schema if type == "table"])
+  con.execute("ATTACH DATABASE ? AS copy", (path,))
+  try:
+    for name in tables:
+      con.execute("INSERT INTO copy.%s SELECT * FROM main.%s" % (name, name))
+    con.commit()
+  finally:
+    con.execute("DETACH DATABASE copy")
+  _execute(dbapi, path, [sql for type, name, sql in schema if type != "table"])
+
+def _execute(dbapi, path, statements):
+  con = dbapi.connect(path)
+  try:
+    for statement in statements:
+      con.execute(statement)
+    con.commit()
+  finally:
+    con.close()
+
+
+# Unit tests below
+#----------------------------------------------------------------------------
+
+class TestStorage(unittest.TestCase):
+
+  def setUp(self):
+    import tempfile
+    from sqlalchemy import MetaData, Table, Column, Integer, String
+    self.directory = tempfile.mkdtemp()
+    self.url = "sqlite:///%s" % os.path.join(self.directory, "test.sqlite")
+    self.metadata = MetaData()
+    self.table = Table("item", self.metadata, Column("id", Integer, primary_key=True), Column("name", String(20)))
+    self.engines = []
+
+  def tearDown(self):
+    import shutil
+    for engine in self.engines:
+      engine.dispose()
+    shutil.rmtree(self.directory)
+
+  def _bind(self, mode):
+    engine = bind(self.metadata, self.url, mode)
+    self.engines.append(engine)
+    return engine
+
+  def _names(self, engine):
+    return [row[0] for row in engine.execute("SELECT name FROM item ORDER BY id")]
+
+  def testFast(self):
+    engine = self._bind("fast")
+    engine.execute(self.table.insert(), [{'name': "a"}, {'name': "b"}])
+    self.assertEquals("wal", engine.execute("PRAGMA journal_mode").scalar())
+    self.assertEquals(1, engine.execute("PRAGMA synchronous").scalar())  # NORMAL
+    self.assertEquals(-64 * 1024, engine.execute("PRAGMA cache_size").scalar())
+    self.assertEquals(["a", "b"], self._names(self._bind("default")))
+
+  def testMemory(self):
+    self._bind("default").execute(self.table.insert(), [{'name': "a"}, {'name': "b"}])
+    self.engines[0].dispose()
+    memory = self._bind("memory")
+    self.assertTrue(is_memory(memory))
+    self.assertEquals(self.url, source_url(memory))
+    self.assertEquals(["a", "b"], self._names(memory))
+    memory.execute(self.table.insert(), {'name': "c"})
+    self.assertEquals(["a", "b"], self._names(self._bind("default")), "Nothing is written before save()")
+    self.engines[-1].dispose()
+    save(memory, self.url)
+    self.assertEquals(["a", "b", "c"], self._names(self._bind("default")))
+
+  def testLoadWithTrigger(self):
+    default = self._bind("default")
+    default.execute("CREATE TABLE log (name VARCHAR(20))")
+    default.execute("CREATE TRIGGER item_log AFTER INSERT ON item BEGIN INSERT INTO log VALUES (new.name); END")
+    default.execute(self.table.insert(), [{'name': "a"}, {'name': "b"}])
+    default.dispose()
+    memory = create_engine(self.url, "memory")
+    self.engines.append(memory)
+    self.metadata.create_all(bind=memory)
+    memory.execute("CREATE TABLE log (name VARCHAR(20))")
+    memory.execute("CREATE TRIGGER item_log AFTER INSERT ON item BEGIN INSERT INTO log VALUES (new.name); END")
+    load(memory, self.metadata, self.url)
+    self.assertEquals(["a", "b"], self._names(memory))
+    self.assertEquals(0, memory.execute("SELECT count(*) FROM log").scalar(), "The trigger should not fire on the loaded rows")
+    memory.execute(self.table.insert(), {'name': "c"})
+    self.assertEquals(1, memory.execute("SELECT count(*) FROM log").scalar())
+
+  def testMemoryWithoutFile(self):
+    memory = self._bind("memory")
+    self.assertEquals([], self._names(memory))
+    self.assertFalse(os.path.exists(os.path.join(self.directory, "test.sqlite")))
+
+  def testSaveByCopy(self):
+    global VACUUM_INTO
+    memory = self._bind("memory")
+    memory.execute("CREATE INDEX item_name ON item (name)")
+    memory.execute("CREATE TABLE log (name VARCHAR(20))")
+    memory.execute("CREATE TRIGGER item_log AFTER INSERT ON item BEGIN INSERT INTO log VALUES (new.name); END")
+    memory.execute(self.table.insert(), [{'name': "a"}, {'name': "b"}])
+    old = VACUUM_INTO
+    VACUUM_INTO = (99,)  # Every SQLite is older
+    try:
+      save(memory, self.url)
+    finally:
+      VACUUM_INTO = old
+    default = self._bind("default")
+    self.assertEquals(["a", "b"], self._names(default))
+    self.assertEquals(["a", "b"], [row[0] for row in default.execute("SELECT name FROM log")], "The trigger should not fire on the copy")
+    self.assertEquals(["item_log", "item_name"], [row[0] for row in default.execute("SELECT name FROM sqlite_master WHERE type IN ('index', 'trigger') ORDER BY name")])
+    default.execute(self.table.insert(), {'name': "c"})
+    self.assertEquals(3, default.execute("SELECT count(*) FROM log").scalar())
+
+  def testSaveInUse(self):
+    self._bind("default").execute(self.table.insert(), {'name': "a"})
+    memory = self._bind("memory")
+    memory.execute(self.table.insert(), {'name': "b"})
+    reader = memory.dialect.dbapi.connect(os.path.join(self.directory, "test.sqlite"), isolation_level=None)
+    try:
+      reader.execute("BEGIN")
+      reader.execute("SELECT name FROM item").fetchall()  # Holds a shared lock until the transaction ends
+      self.assertRaises(Exception, save, memory, self.url)
+    finally:
+      reader.close()
+    self.assertFalse(os.path.exists(os.path.join(self.directory, "test.sqlite.saving")))
+    save(memory, self.url)
+    self.assertEquals(["a", "b"], self._names(self._bind("default")))
+
+  def testFastThenMemory(self):
+    path = os.path.join(self.directory, "test.sqlite")
+    fast = self._bind("fast")
+    fast.execute(self.table.insert(), [{'name': "a"}, {'name': "b"}])
+    close(fast)
+    self.assertFalse(os.path.exists(path + "-wal") and os.path.getsize(path + "-wal"), "The log should be checkpointed into the file")
+    self.assertTrue(os.path.getsize(path) > 0)
+    for name in ("c", "d"):
+      memory = self._bind("memory")
+      memory.execute(self.table.insert(), {'name': name})
+      save(memory, self.url)
+      self.assertEquals([], [suffix for suffix in ("-wal", "-shm") if os.path.exists(path + suffix)])
+    default = self._bind("default")
+    self.assertEquals("delete", default.execute("PRAGMA journal_mode").scalar())
+    self.assertEquals(["a", "b", "c", "d"], self._names(default))
+
+  def testUnknownMode(self):
+    self.assertRaises(Exception, create_engine, self.url, "turbo")
+
+
+if __name__ == "__main__":
+  unittest.main()
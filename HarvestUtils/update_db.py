@@ -22,49 +22,126 @@ You should have received a copy of the GNU General Public License
 along with HarvestUtils.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import inspect 
+import csv
 import logging
 import os
 import sys
+from optparse import OptionParser
 
 from config import cfg
-from mapper import CSVDBMapper, POMapper, CWMapper   
-from model import TimeEntry, POEntry, CWEntry
+from csvparser import ParallelCSVFile, arity
+from mapper import CSVDBMapper, BulkCSVDBMapper, POMapper, CWMapper   
+from model import metadata, TimeEntry, POEntry, CWEntry
+import profiling
+import rollup
+import storage
 
 log = logging.getLogger("update_db")
 
-def _get_mapper(path):
+def _get_mapper_class(path, bulk=False):
   handle = file(path, 'r')
-  length = len(handle.readline().split(","))   
+  length = len(csv.reader([handle.readline()]).next())
   
-  if length is len(inspect.getargspec(TimeEntry.__init__)[0]) - 1:
+  if length == arity(TimeEntry):
     log.info("File %s contains %d fields, it is a Harvest file" % (path, length))
-    return CSVDBMapper(path)
-  elif length is len(inspect.getargspec(POEntry.__init__)[0]) - 1:
+    if bulk:
+      return BulkCSVDBMapper
+    return CSVDBMapper
+  elif length == arity(POEntry):
     log.info("File %s contains %d fields, it is a PurchaseOrder file" % (path, length))
-    return POMapper(path)
-  elif length is len(inspect.getargspec(CWEntry.__init__)[0]) - 1:
+    return POMapper
+  elif length == arity(CWEntry):
     log.info("File %s contains %d fields, it is a CoWorker file" % (path, length))
-    return CWMapper(path)
+    return CWMapper
   else:
     log.warning("File %s contains %d fields, it is of UNKNOWN type!" % (path, length))
     return None
 
+def _get_mapper(path, bulk=False):
+  cls = _get_mapper_class(path, bulk)
+  if cls is None:
+    return None
+  return cls(path)
+
+def _map_parallel(files, jobs, bulk=False):
+  """
+    Parse the files in a pool of worker processes while this process maps
+    the parsed entries to the DB, one file at a time in the given order.
+    Every file is split into byte ranges that the workers parse into
+    batches of rows (see ParallelCSVFile), all files share the same pool.
+    The workers never touch the DB, this process is the only writer, so
+    the customers, projects and employees are looked up here.
+  """
+  from multiprocessing import Pool
+
+  pool = Pool(jobs)
+  try:
+    for csvfile in files:
+      cls = _get_mapper_class(csvfile, bulk)
+      if cls is None:
+        log.error("Unknown file format for %s" % csvfile)
+        continue
+      log.info("Starting to map %s to the DB" % csvfile)
+      cls(csvfile, ParallelCSVFile(csvfile, cls.ENTRY, jobs, pool=pool)).map()
+  finally:
+    pool.close()
+    pool.join()
+
 if __name__ == "__main__":
   logging.basicConfig(level=cfg['loglevel'],format=cfg['logformat'])
-  if len(sys.argv) > 1:
+  parser = OptionParser(usage="update_db.py [options] <csvfile> ...")
+  parser.add_option("--bulk", action="store_true", default=False,
+                    help="insert Harvest time entries with bulk inserts")
+  parser.add_option("-j", "--jobs", type="int", default=1,
+                    help="number of processes that parse the files")
+  parser.add_option("--rebuild-rollups", action="store_true", default=False,
+                    help="recompute the report rollups from all tasks")
+  parser.add_option("--snapshot", action="store_true", default=False,
+                    help="update the columnar snapshot next to the DB (needs NumPy)")
+  profiling.add_options(parser)
+  (options, args) = parser.parse_args()
+  profiling.start_from_options(options, metadata.bind)
+  if options.rebuild_rollups:
+    profiling.current().begin("rebuild-rollups")
+    tasks = rollup.rebuild()
+    profiling.current().end(tasks)
+    log.info("Rebuilt the rollups from %d tasks" % tasks)
+
+  if len(args) > 0:
     
-    for csvfile in sys.argv[1:]:
+    files = []
+    for csvfile in args:
       if os.path.exists(csvfile):
+        files.append(csvfile)
+      else:
+        log.error("File %s does not exist. Exiting" % csvfile)
+
+    if options.jobs > 1:
+      _map_parallel(files, options.jobs, options.bulk)
+    else:
+      for csvfile in files:
         log.info("Starting to map %s to the DB" % csvfile)
-        mapper = _get_mapper(csvfile)
+        mapper = _get_mapper(csvfile, options.bulk)
       
         if mapper is not None:
           mapper.map()
         else:
           log.error("Unknown file format for %s" % csvfile)
-      else:
-        log.error("File %s does not exist. Exiting" % csvfile)
 
-  else:
-    print "Usage: update_db.py <csvfile>"
+  elif not options.rebuild_rollups and not options.snapshot:
+    parser.print_usage()
+
+  if options.snapshot:
+    import columnar
+    path = columnar.snapshot_path()
+    profiling.current().begin("snapshot")
+    months = columnar.write_snapshot(path)
+    profiling.current().end(len(months))
+    log.info("Wrote %d months to the snapshot in %s" % (len(months), path))
+
+  if storage.is_memory(metadata.bind) and (len(args) > 0 or options.rebuild_rollups):
+    profiling.current().begin("save")
+    storage.save(metadata.bind, cfg['db.bind'])
+    profiling.current().end()
+  profiling.stop_from_options(options)
+  storage.close(metadata.bind)